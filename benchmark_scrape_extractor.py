@@ -0,0 +1,71 @@
+import os
+import re
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+from news_scraper_serverless_function import extract_main_text
+
+# Usage: python benchmark_scrape_extractor.py [saved_page.html | directory_of_saved_pages ...]
+# Without arguments the pages in benchmark_fixtures/ are used, followed by synthetic news pages with
+# increasingly deep div nesting.
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_fixtures')
+
+def legacy_extract(soup):
+    content = ''
+    for tag in soup.find_all(['p', 'article', 'div']):
+        text = tag.get_text(strip=True)
+        if text and len(text) > 50:
+            content += text + ' '
+    return re.sub(r'\s+', ' ', content).strip()
+
+def synthetic_page(depth, paragraphs=30):
+    body = ''.join(
+        f"<p>پاراگراف {i} از متن اصلی خبر، شامل جزئیات رویداد و نقل قول‌ها، که باید تنها یک بار استخراج شود.</p>"
+        for i in range(paragraphs)
+    )
+    article = f"<div class='article-body'>{body}</div>"
+    for level in range(depth):
+        article = f"<div class='wrapper-{level}'>{article}</div>"
+    nav = ''.join(f"<li><a href='/c/{i}'>دسته {i}</a></li>" for i in range(20))
+    return f"<html><head><title>t</title></head><body><nav><ul>{nav}</ul></nav>{article}<footer>کپی‌رایت</footer></body></html>"
+
+def read_page(path):
+    with open(path, encoding='utf-8', errors='replace') as page_file:
+        return page_file.read()
+
+def load_fixtures(paths):
+    fixtures = []
+    for path in paths or [FIXTURES_DIR]:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(('.html', '.htm')):
+                    fixtures.append((name, read_page(os.path.join(path, name))))
+        elif os.path.exists(path):
+            fixtures.append((os.path.basename(path), read_page(path)))
+    if not paths:
+        fixtures += [(f"synthetic-depth-{depth}", synthetic_page(depth)) for depth in (2, 8, 16, 32)]
+    return fixtures
+
+def time_extractor(extractor, page, repeat):
+    best = None
+    content = ''
+    for _ in range(repeat):
+        soup = BeautifulSoup(page, 'lxml')
+        started = time.perf_counter()
+        content = extractor(soup)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, content
+
+def main(argv):
+    repeat = int(os.environ.get('BENCH_REPEAT', 5))
+    print(f"{'fixture':<28} {'legacy ms':>10} {'legacy chars':>13} {'new ms':>8} {'new chars':>10}")
+    for name, page in load_fixtures(argv):
+        legacy_time, legacy_content = time_extractor(legacy_extract, page, repeat)
+        new_time, new_content = time_extractor(extract_main_text, page, repeat)
+        print(f"{name[:28]:<28} {legacy_time * 1000:>10.2f} {len(legacy_content):>13} {new_time * 1000:>8.2f} {len(new_content):>10}")
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
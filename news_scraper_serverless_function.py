@@ -3,9 +3,17 @@ import json
 import time
 import re
 import random
+import calendar
+import math
+import codecs
+import hashlib
+import sqlite3
+import zlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from datetime import datetime
 import html
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 
 try:
     from feedparser import parse as parse_rss
@@ -19,6 +27,334 @@ from appwrite.client import Client
 from appwrite.services.databases import Databases
 from appwrite.query import Query
 
+DEFAULT_STAGE_CONCURRENCY = {
+    'feed': 8,
+    'scrape': 8,
+    'ai': 4,
+    'store': 4,
+    'local_llm': 1
+}
+STAGE_SEMAPHORES = {}
+STAGE_SEMAPHORES_LOCK = threading.Lock()
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+STATE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS feed_validators (
+    feed_url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    body_hash TEXT,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS seen_entries (
+    feed_url TEXT,
+    entry_key TEXT,
+    published REAL,
+    seen_at REAL,
+    PRIMARY KEY (feed_url, entry_key)
+);
+CREATE TABLE IF NOT EXISTS entry_failures (
+    feed_url TEXT,
+    entry_key TEXT,
+    attempts INTEGER,
+    updated_at REAL,
+    PRIMARY KEY (feed_url, entry_key)
+);
+CREATE TABLE IF NOT EXISTS feed_high_water (
+    feed_url TEXT PRIMARY KEY,
+    published REAL
+);
+CREATE TABLE IF NOT EXISTS provider_stats (
+    provider_id TEXT PRIMARY KEY,
+    successes REAL,
+    attempts REAL,
+    latencies TEXT,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS llm_cache (
+    cache_key TEXT PRIMARY KEY,
+    result TEXT,
+    created_at REAL,
+    last_access REAL
+);
+CREATE TABLE IF NOT EXISTS page_cache (
+    url_hash TEXT PRIMARY KEY,
+    url TEXT,
+    content BLOB,
+    size INTEGER,
+    created_at REAL,
+    last_access REAL
+);
+"""
+STATE_DB = None
+STATE_DB_LOCK = threading.Lock()
+
+CACHE_STATS = {}
+CACHE_STATS_LOCK = threading.Lock()
+
+def get_int_env(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+def get_float_env(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+def stage_slot(stage):
+    # Per-stage limits are read from FEED_CONCURRENCY, SCRAPE_CONCURRENCY, AI_CONCURRENCY, STORE_CONCURRENCY
+    # and LOCAL_LLM_CONCURRENCY.
+    with STAGE_SEMAPHORES_LOCK:
+        if stage not in STAGE_SEMAPHORES:
+            limit = max(1, get_int_env(f"{stage.upper()}_CONCURRENCY", DEFAULT_STAGE_CONCURRENCY.get(stage, 1)))
+            STAGE_SEMAPHORES[stage] = threading.BoundedSemaphore(limit)
+        return STAGE_SEMAPHORES[stage]
+
+def get_state_db():
+    # Small SQLite store for state that should outlive a single invocation. STATE_DB_PATH can point at a mounted volume.
+    global STATE_DB
+    if STATE_DB is None:
+        path = os.environ.get('STATE_DB_PATH', '/tmp/news_scraper_state.sqlite3')
+        connection = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        connection.executescript(STATE_DB_SCHEMA)
+        STATE_DB = connection
+    return STATE_DB
+
+def state_db_execute(sql, params=()):
+    with STATE_DB_LOCK:
+        connection = get_state_db()
+        rows = connection.execute(sql, params).fetchall()
+        connection.commit()
+        return rows
+
+def record_cache_event(cache_name, hit):
+    with CACHE_STATS_LOCK:
+        stats = CACHE_STATS.setdefault(cache_name, {'hits': 0, 'misses': 0})
+        stats['hits' if hit else 'misses'] += 1
+
+def reset_cache_stats():
+    # A warm runtime reuses this module, so each run starts its counters from zero.
+    with CACHE_STATS_LOCK:
+        CACHE_STATS.clear()
+
+def format_cache_stats():
+    with CACHE_STATS_LOCK:
+        if not CACHE_STATS:
+            return "no cache lookups"
+        return ', '.join(f"{name}: {stats['hits']} hits / {stats['misses']} misses" for name, stats in sorted(CACHE_STATS.items()))
+
+def load_feed_validators(feed_url, context):
+    try:
+        rows = state_db_execute(
+            "SELECT etag, last_modified, body_hash FROM feed_validators WHERE feed_url = ?",
+            (feed_url,)
+        )
+    except Exception as e:
+        context.log(f"Failed to load feed validators for {feed_url}: {str(e)}")
+        return {}
+    if not rows:
+        return {}
+    etag, last_modified, body_hash = rows[0]
+    return {"etag": etag, "last_modified": last_modified, "body_hash": body_hash}
+
+def save_feed_validators(feed_url, validators, context):
+    try:
+        state_db_execute(
+            "INSERT OR REPLACE INTO feed_validators (feed_url, etag, last_modified, body_hash, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (feed_url, validators.get('etag'), validators.get('last_modified'), validators.get('body_hash'), time.time())
+        )
+    except Exception as e:
+        context.log(f"Failed to save feed validators for {feed_url}: {str(e)}")
+
+def fetch_feed_if_changed(rss_url, context):
+    # Returns (feed_data, validators). A 304 or a body identical to the last poll comes back as (None, None).
+    # The caller saves the returned validators once every new entry in the feed has been handled.
+    validators = load_feed_validators(rss_url, context)
+    headers = {'User-Agent': USER_AGENT}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+
+    response = requests.get(rss_url, headers=headers, timeout=get_int_env('FEED_TIMEOUT', 10))
+    if response.status_code == 304:
+        context.log(f"Feed not modified (304): {rss_url}")
+        return None, None
+    response.raise_for_status()
+
+    body = response.content
+    new_validators = {
+        "etag": response.headers.get('ETag') or validators.get('etag'),
+        "last_modified": response.headers.get('Last-Modified') or validators.get('last_modified'),
+        "body_hash": hashlib.sha256(body).hexdigest()
+    }
+    if validators.get('body_hash') == new_validators['body_hash']:
+        context.log(f"Feed body unchanged since last poll: {rss_url}")
+        save_feed_validators(rss_url, new_validators, context)
+        return None, None
+
+    feed_data = parse_rss(body, response_headers={
+        'content-type': response.headers.get('Content-Type', ''),
+        'content-location': response.url
+    })
+    return feed_data, new_validators
+
+TRACKING_QUERY_PARAMS = ('utm_', 'fbclid', 'gclid', 'ocid', 'cmpid', 'at_medium', 'at_campaign')
+
+def canonicalize_url(url):
+    parsed = urlparse(url.strip())
+    query = [
+        (key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+        if not key.lower().startswith(TRACKING_QUERY_PARAMS)
+    ]
+    path = parsed.path.rstrip('/') or '/'
+    return urlunparse((parsed.scheme.lower(), parsed.netloc.lower(), path, parsed.params, urlencode(query), ''))
+
+def get_entry_key(entry):
+    guid = entry.get('id') or entry.get('guid')
+    if guid:
+        return guid.strip()
+    link = entry.get('link', '')
+    return canonicalize_url(link) if link else None
+
+def get_entry_published(entry):
+    parsed_time = entry.get('published_parsed') or entry.get('updated_parsed')
+    if not parsed_time:
+        return None
+    try:
+        return float(calendar.timegm(parsed_time))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+def sort_entries_newest_first(entries):
+    # Entries without a date keep their feed order after the dated ones.
+    indexed = list(enumerate(entries))
+    indexed.sort(key=lambda item: (-(get_entry_published(item[1]) or 0), item[0]))
+    return [entry for _, entry in indexed]
+
+def load_seen_index(feed_url, context):
+    try:
+        seen_keys = {row[0] for row in state_db_execute(
+            "SELECT entry_key FROM seen_entries WHERE feed_url = ?", (feed_url,)
+        )}
+        rows = state_db_execute("SELECT published FROM feed_high_water WHERE feed_url = ?", (feed_url,))
+    except Exception as e:
+        context.log(f"Failed to load seen-entry index for {feed_url}: {str(e)}")
+        return set(), None
+    return seen_keys, rows[0][0] if rows else None
+
+def is_entry_seen(entry, seen_keys, high_water):
+    entry_key = get_entry_key(entry)
+    if entry_key and entry_key in seen_keys:
+        return True
+    published = get_entry_published(entry)
+    return bool(published and high_water and published < high_water)
+
+def mark_entry_seen(feed_url, entry, context):
+    entry_key = get_entry_key(entry)
+    if not entry_key:
+        return
+    published = get_entry_published(entry)
+    try:
+        state_db_execute(
+            "INSERT OR REPLACE INTO seen_entries (feed_url, entry_key, published, seen_at) VALUES (?, ?, ?, ?)",
+            (feed_url, entry_key, published, time.time())
+        )
+        state_db_execute(
+            "DELETE FROM seen_entries WHERE feed_url = ? AND entry_key NOT IN "
+            "(SELECT entry_key FROM seen_entries WHERE feed_url = ? ORDER BY seen_at DESC LIMIT ?)",
+            (feed_url, feed_url, get_int_env('SEEN_ENTRIES_PER_FEED', 500))
+        )
+        state_db_execute("DELETE FROM entry_failures WHERE feed_url = ? AND entry_key = ?", (feed_url, entry_key))
+    except Exception as e:
+        context.log(f"Failed to record seen entry {entry_key} for {feed_url}: {str(e)}")
+
+def record_entry_failure(feed_url, entry, context):
+    # Returns True once the entry has failed ENTRY_MAX_ATTEMPTS times and is marked seen for good,
+    # False while it stays unseen so a later run retries it.
+    entry_key = get_entry_key(entry)
+    if not entry_key:
+        return True
+    max_attempts = max(1, get_int_env('ENTRY_MAX_ATTEMPTS', 3))
+    try:
+        state_db_execute(
+            "INSERT INTO entry_failures (feed_url, entry_key, attempts, updated_at) VALUES (?, ?, 1, ?) "
+            "ON CONFLICT(feed_url, entry_key) DO UPDATE SET attempts = attempts + 1, updated_at = excluded.updated_at",
+            (feed_url, entry_key, time.time())
+        )
+        attempts = state_db_execute(
+            "SELECT attempts FROM entry_failures WHERE feed_url = ? AND entry_key = ?", (feed_url, entry_key)
+        )[0][0]
+    except Exception as e:
+        context.log(f"Failed to record failed entry {entry_key} for {feed_url}: {str(e)}")
+        return False
+    if attempts < max_attempts:
+        context.log(f"Entry {entry_key} failed ({attempts}/{max_attempts} attempts). Leaving it unseen for the next run")
+        return False
+    context.log(f"Entry {entry_key} failed {attempts} times. Giving up on it")
+    mark_entry_seen(feed_url, entry, context)
+    return True
+
+def advance_high_water(feed_url, entries, context, pending=()):
+    # The mark never moves past an entry still waiting to be processed, since is_entry_seen skips
+    # everything strictly older than it.
+    published = max((get_entry_published(entry) or 0 for entry in entries), default=0)
+    pending_published = [get_entry_published(entry) for entry in pending if get_entry_published(entry)]
+    if pending_published:
+        published = min(published, min(pending_published))
+    if not published:
+        return
+    try:
+        state_db_execute(
+            "INSERT INTO feed_high_water (feed_url, published) VALUES (?, ?) "
+            "ON CONFLICT(feed_url) DO UPDATE SET published = MAX(published, excluded.published)",
+            (feed_url, published)
+        )
+    except Exception as e:
+        context.log(f"Failed to advance high-water mark for {feed_url}: {str(e)}")
+
+def get_page_cache_key(url):
+    return hashlib.sha256(canonicalize_url(url).encode('utf-8')).hexdigest()
+
+def load_cached_page_text(url, context):
+    try:
+        rows = state_db_execute(
+            "SELECT content, created_at FROM page_cache WHERE url_hash = ?",
+            (get_page_cache_key(url),)
+        )
+        if not rows or time.time() - rows[0][1] > get_int_env('PAGE_CACHE_TTL', 21600):
+            record_cache_event('page_cache', False)
+            return None
+        state_db_execute("UPDATE page_cache SET last_access = ? WHERE url_hash = ?", (time.time(), get_page_cache_key(url)))
+        record_cache_event('page_cache', True)
+        return zlib.decompress(rows[0][0]).decode('utf-8')
+    except Exception as e:
+        context.log(f"Page cache lookup failed for {url}: {str(e)}")
+        return None
+
+def save_cached_page_text(url, content, context):
+    try:
+        compressed = zlib.compress(content.encode('utf-8'), 6)
+        now = time.time()
+        state_db_execute(
+            "INSERT OR REPLACE INTO page_cache (url_hash, url, content, size, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+            (get_page_cache_key(url), url, compressed, len(compressed), now, now)
+        )
+        # Expired rows go first, then least recently used rows until the cache fits PAGE_CACHE_MAX_BYTES.
+        state_db_execute("DELETE FROM page_cache WHERE created_at < ?", (now - get_int_env('PAGE_CACHE_TTL', 21600),))
+        state_db_execute(
+            "DELETE FROM page_cache WHERE url_hash IN ("
+            "SELECT url_hash FROM (SELECT url_hash, SUM(size) OVER (ORDER BY last_access DESC) AS running_size FROM page_cache) "
+            "WHERE running_size > ?)",
+            (get_int_env('PAGE_CACHE_MAX_BYTES', 20 * 1024 * 1024),)
+        )
+    except Exception as e:
+        context.log(f"Page cache store failed for {url}: {str(e)}")
+
 def truncate_text(text, max_chars=2000):
     if not text or len(text) <= max_chars:
         return text or ""
@@ -37,363 +373,2155 @@ def shorten_url(url, max_length=250):
         return base
     return base[:max_length-3] + '...'
 
+def html_to_text(fragment):
+    text = re.sub(r'<(script|style)[^>]*>.*?</\1>', ' ', fragment or '', flags=re.S | re.I)
+    text = html.unescape(re.sub(r'<[^>]+>', ' ', text))
+    return re.sub(r'\s+', ' ', text).strip()
+
+def get_embedded_full_text(entry):
+    # feedparser exposes content:encoded (and Atom <content>) as entry.content.
+    best = ''
+    for content in entry.get('content') or []:
+        text = html_to_text(content.get('value', ''))
+        if len(text) > len(best):
+            best = text
+    return best
+
+# <form> stays: ASP.NET WebForms sites wrap the whole page, article included, in a single form.
+BOILERPLATE_TAGS = ['script', 'style', 'noscript', 'nav', 'header', 'footer', 'aside', 'iframe', 'svg', 'button', 'select']
+POSITIVE_CONTENT_HINTS = re.compile(r'article|body|content|entry|main|news|post|story|text|detail', re.I)
+NEGATIVE_CONTENT_HINTS = re.compile(r'ad-|ads|advert|banner|comment|footer|menu|nav|popup|promo|related|share|sidebar|social|sponsor|subscribe|widget', re.I)
+
+def get_class_weight(tag):
+    hints = ' '.join(tag.get('class') or []) + ' ' + (tag.get('id') or '')
+    weight = 0
+    if POSITIVE_CONTENT_HINTS.search(hints):
+        weight += 25
+    if NEGATIVE_CONTENT_HINTS.search(hints):
+        weight -= 25
+    return weight
+
+def get_link_density(tag, text_length):
+    if not text_length:
+        return 1.0
+    link_length = sum(len(link.get_text(strip=True)) for link in tag.find_all('a'))
+    return min(1.0, link_length / text_length)
+
+def extract_main_text(soup):
+    # Readability-style scoring: every paragraph is read once and credits its parent and grandparent,
+    # so the work is linear in the size of the page and each paragraph lands in the output at most once.
+    for tag in soup(BOILERPLATE_TAGS):
+        tag.decompose()
+
+    paragraphs = []
+    candidates = {}
+    scores = {}
+    for node in soup.find_all(['p', 'pre', 'blockquote']):
+        text = node.get_text(' ', strip=True)
+        if len(text) < 25:
+            continue
+        parent = node.parent
+        grandparent = parent.parent if parent is not None else None
+        paragraphs.append((text, parent, grandparent))
+        score = 1 + text.count(',') + text.count('،') + min(len(text) // 100, 3)
+        for ancestor, share in ((parent, 1.0), (grandparent, 0.5)):
+            if ancestor is None or ancestor.name in (None, '[document]'):
+                continue
+            key = id(ancestor)
+            if key not in candidates:
+                candidates[key] = ancestor
+                scores[key] = get_class_weight(ancestor)
+            scores[key] += score * share
+
+    if candidates:
+        # Link density needs the candidate's full text, so it is only computed for the few best candidates.
+        best_keys = sorted(scores, key=scores.get, reverse=True)[:5]
+        for key in best_keys:
+            candidate = candidates[key]
+            scores[key] *= 1 - get_link_density(candidate, len(candidate.get_text(strip=True)))
+        top_key = max(best_keys, key=scores.get)
+        top = candidates[top_key]
+        threshold = max(10, scores[top_key] * 0.2)
+        siblings = {
+            id(sibling) for sibling in (top.parent.find_all(recursive=False) if top.parent is not None else [])
+            if scores.get(id(sibling), 0) >= threshold
+        }
+        siblings.add(top_key)
+        selected = [
+            text for text, parent, grandparent in paragraphs
+            if id(parent) in siblings or (grandparent is not None and id(grandparent) in siblings)
+        ]
+        content = ' '.join(selected)
+    else:
+        content = ''
+
+    if not content:
+        seen = set()
+        fallback = []
+        for text, _, _ in paragraphs:
+            if len(text) > 50 and text not in seen:
+                seen.add(text)
+                fallback.append(text)
+        content = ' '.join(fallback)
+    if not content and soup.body is not None:
+        content = soup.body.get_text(' ', strip=True)
+    return re.sub(r'\s+', ' ', content).strip()
+
+JSON_LD_PATTERN = re.compile(r'<script[^>]+type\s*=\s*["\']?application/ld\+json["\']?[^>]*>(.*?)</script>', re.S | re.I)
+OG_DESCRIPTION_PATTERN = re.compile(r'<meta[^>]+property\s*=\s*["\']og:description["\'][^>]*>', re.I)
+META_CONTENT_PATTERN = re.compile(r'content\s*=\s*(["\'])(.*?)\1', re.S | re.I)
+ARTICLE_LD_TYPES = {'Article', 'NewsArticle', 'ReportageNews', 'AnalysisNewsArticle', 'BlogPosting', 'WebPage'}
+
+def iter_json_ld_nodes(data):
+    if isinstance(data, list):
+        for item in data:
+            yield from iter_json_ld_nodes(item)
+    elif isinstance(data, dict):
+        yield data
+        if '@graph' in data:
+            yield from iter_json_ld_nodes(data['@graph'])
+        if isinstance(data.get('mainEntity'), (dict, list)):
+            yield from iter_json_ld_nodes(data['mainEntity'])
+
+def extract_structured_text(page_html):
+    # Cheap regex scan for JSON-LD articleBody (and a long og:description) so most news pages
+    # never need a BeautifulSoup tree. Returns '' when nothing usable is found.
+    best = ''
+    for block in JSON_LD_PATTERN.findall(page_html):
+        try:
+            data = json.loads(block.strip(), strict=False)
+        except ValueError:
+            continue
+        for node in iter_json_ld_nodes(data):
+            node_types = node.get('@type')
+            node_types = set(node_types) if isinstance(node_types, list) else {node_types}
+            body = node.get('articleBody')
+            if not isinstance(body, str) or not node_types & ARTICLE_LD_TYPES:
+                continue
+            body = html_to_text(body)
+            if len(body) > len(best):
+                best = body
+    if not best:
+        meta = OG_DESCRIPTION_PATTERN.search(page_html)
+        content = META_CONTENT_PATTERN.search(meta.group(0)) if meta else None
+        if content:
+            best = html_to_text(content.group(2))
+    return best
+
+HEADER_CHARSET_PATTERN = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.I)
+META_CHARSET_PATTERN = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?([\w.:-]+)', re.I)
+ARABIC_SCRIPT_PATTERN = re.compile(r'[\u0600-\u06ff]')
+HIGH_BYTE_PATTERN = re.compile(rb'[\x80-\xff]')
+DOMAIN_ENCODINGS = {}
+DOMAIN_ENCODINGS_LOCK = threading.Lock()
+
+def normalize_encoding(name):
+    try:
+        return codecs.lookup(name.strip()).name
+    except (LookupError, AttributeError):
+        return None
+
+def sniff_encoding(sample):
+    # Returns None for a plain ASCII sample, which every candidate encoding decodes the same way.
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    if not HIGH_BYTE_PATTERN.search(sample):
+        return None
+    try:
+        # A non-final incremental decode tolerates a multi-byte sequence cut off at the end of the sample.
+        codecs.getincrementaldecoder('utf-8')(errors='strict').decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    high_bytes = bytes(byte for byte in sample if byte >= 0x80)
+    arabic_chars = len(ARABIC_SCRIPT_PATTERN.findall(high_bytes.decode('cp1256', errors='ignore')))
+    return 'cp1256' if high_bytes and arabic_chars >= len(high_bytes) * 0.6 else 'cp1252'
+
+def detect_page_encoding(url, content_type, head, final=False):
+    # HTTP header first, then a per-domain cache, then <meta charset> in the first 4 KB, then a bounded sniff
+    # of CHARSET_SNIFF_BYTES starting at the first non-ASCII byte, since heads, scripts and CSS are mostly ASCII.
+    # Returns None while head holds too little non-ASCII text to decide and more of the page is coming.
+    # Only a meta charset or a conclusive sniff is cached for the domain.
+    header_match = HEADER_CHARSET_PATTERN.search(content_type or '')
+    header_encoding = normalize_encoding(header_match.group(1)) if header_match else None
+    if header_encoding:
+        return header_encoding
+    domain = urlparse(url).netloc.lower()
+    with DOMAIN_ENCODINGS_LOCK:
+        if domain in DOMAIN_ENCODINGS:
+            return DOMAIN_ENCODINGS[domain]
+    meta_match = META_CHARSET_PATTERN.search(head[:4096])
+    encoding = normalize_encoding(meta_match.group(1).decode('ascii', 'ignore')) if meta_match else None
+    if not encoding:
+        high_byte = HIGH_BYTE_PATTERN.search(head)
+        sniff_start = high_byte.start() if high_byte else len(head)
+        sample = head[sniff_start:sniff_start + get_int_env('CHARSET_SNIFF_BYTES', 16384)]
+        if not final and len(sample) < get_int_env('CHARSET_SNIFF_BYTES', 16384):
+            return None
+        encoding = sniff_encoding(sample)
+        if not encoding:
+            # An all-ASCII page decodes the same either way; say nothing about the domain.
+            return 'utf-8'
+    with DOMAIN_ENCODINGS_LOCK:
+        DOMAIN_ENCODINGS[domain] = encoding
+    return encoding
+
+def get_incremental_decoder(encoding):
+    try:
+        return codecs.getincrementaldecoder(encoding)(errors='replace')
+    except (LookupError, TypeError):
+        return codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+def download_page_html(url, headers, context):
+    # Streams the page and decodes it chunk by chunk, stopping at </body> or SCRAPE_MAX_BYTES,
+    # so memory per page stays bounded regardless of how much inline script a site ships.
+    # Bytes are held back until the encoding is known, which for a page without a declared charset
+    # means until CHARSET_SNIFF_BYTES past the first non-ASCII byte.
+    max_bytes = get_int_env('SCRAPE_MAX_BYTES', 1536 * 1024)
+    sniff_bytes = get_int_env('CHARSET_SNIFF_BYTES', 16384)
+    with requests.get(url, headers=headers, timeout=5, stream=True) as response:
+        response.raise_for_status()
+        content_type = response.headers.get('Content-Type', '')
+        decoder = None
+        head = b''
+        parts = []
+        received = 0
+        for chunk in response.iter_content(chunk_size=16384):
+            if not chunk:
+                continue
+            if received + len(chunk) > max_bytes:
+                chunk = chunk[:max_bytes - received]
+            received += len(chunk)
+            if decoder is None:
+                head += chunk
+                if len(head) < sniff_bytes and received < max_bytes:
+                    continue
+                encoding = detect_page_encoding(url, content_type, head, received >= max_bytes)
+                if encoding is None:
+                    continue
+                decoder = get_incremental_decoder(encoding)
+                chunk, head = head, b''
+            text = decoder.decode(chunk)
+            boundary = (parts[-1][-6:] if parts else '') + text
+            parts.append(text)
+            if received >= max_bytes:
+                context.log(f"Stopped reading {url} at the {max_bytes}-byte cap")
+                break
+            if '</body' in boundary.lower():
+                break
+        if decoder is None:
+            decoder = get_incremental_decoder(detect_page_encoding(url, content_type, head, True))
+            parts.append(decoder.decode(head))
+        parts.append(decoder.decode(b'', final=True))
+    return ''.join(parts)
+
 def scrape_article_text(url, context):
     headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+        'User-Agent': USER_AGENT
     }
+    cached_content = load_cached_page_text(url, context)
+    if cached_content:
+        context.log(f"Using cached scrape for {url}")
+        return cached_content
     context.log(f"Scraping URL {url}")
     try:
-        response = requests.get(url, headers=headers, timeout=5)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'lxml')
-        content = ''
-        for tag in soup.find_all(['p', 'article', 'div']):
-            text = tag.get_text(strip=True)
-            if text and len(text) > 50:
-                content += text + ' '
-        content = re.sub(r'\s+', ' ', content).strip()
+        page_html = download_page_html(url, headers, context)
+        content = extract_structured_text(page_html)
+        if len(content) >= get_int_env('STRUCTURED_TEXT_MIN_CHARS', 500):
+            context.log(f"Using structured data article body for {url} ({len(content)} chars)")
+        else:
+            content = extract_main_text(BeautifulSoup(page_html, 'lxml'))
         if not content:
             context.log(f"No meaningful content found at {url}")
             return "No content available"
+        save_cached_page_text(url, content, context)
         return content
     except Exception as e:
         context.log(f"Scraping failed for {url}: {str(e)}")
         return "Scraping failed"
 
+SENTENCE_SPLIT_PATTERN = re.compile(r'(?<=[.!?؟۔])\s+|\n+')
+WORD_PATTERN = re.compile(r'\w+')
+STOPWORDS = {
+    'the', 'a', 'an', 'and', 'or', 'of', 'to', 'in', 'on', 'for', 'with', 'at', 'by', 'from', 'is', 'are', 'was', 'were',
+    'be', 'been', 'it', 'its', 'that', 'this', 'as', 'has', 'have', 'had', 'he', 'she', 'they', 'said', 'but', 'not',
+    'و', 'در', 'به', 'از', 'که', 'این', 'را', 'با', 'است', 'برای', 'آن', 'یک', 'خود', 'تا', 'بر', 'هم', 'نیز', 'شده',
+    'می', 'شد', 'کرد', 'کند', 'بود', 'های', 'ها', 'او', 'ما', 'اما', 'یا', 'وی', 'همچنین', 'گفت', 'پس', 'اگر'
+}
+
+def estimate_tokens(text):
+    return int(len(WORD_PATTERN.findall(text or '')) * 1.3)
+
+def tokenize_for_ranking(text):
+    return [word for word in WORD_PATTERN.findall(text.lower()) if len(word) > 1 and word not in STOPWORDS]
+
+def compress_content(title, summary, content, token_budget):
+    # Extractive compression: rank sentences by TF-IDF cosine similarity to the title and summary
+    # (plus a small lead bias, since news puts key facts first), keep the best ones up to the token
+    # budget and return them in their original order. Repeated sentences are dropped.
+    if token_budget <= 0 or estimate_tokens(content) <= token_budget:
+        return content
+    sentences = []
+    seen = set()
+    for sentence in SENTENCE_SPLIT_PATTERN.split(content):
+        sentence = sentence.strip()
+        if len(sentence) < 20 or sentence in seen:
+            continue
+        seen.add(sentence)
+        sentences.append(sentence)
+    if not sentences:
+        return truncate_text(content, token_budget * 4)
+
+    tokenized = [tokenize_for_ranking(sentence) for sentence in sentences]
+    document_frequency = {}
+    for tokens in tokenized:
+        for token in set(tokens):
+            document_frequency[token] = document_frequency.get(token, 0) + 1
+    sentence_count = len(sentences)
+    idf = {token: math.log((sentence_count + 1) / (count + 1)) + 1 for token, count in document_frequency.items()}
+
+    def tfidf_vector(tokens):
+        vector = {}
+        for token in tokens:
+            vector[token] = vector.get(token, 0) + idf.get(token, 1.0)
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {token: weight / norm for token, weight in vector.items()}
+
+    query = tfidf_vector(tokenize_for_ranking(f"{title} {summary}"))
+    scored = []
+    for index, tokens in enumerate(tokenized):
+        vector = tfidf_vector(tokens)
+        similarity = sum(weight * query.get(token, 0) for token, weight in vector.items())
+        scored.append((similarity + 0.15 * (1 - index / sentence_count), index))
+
+    selected = []
+    used_tokens = 0
+    for _, index in sorted(scored, reverse=True):
+        sentence_tokens = estimate_tokens(sentences[index])
+        if used_tokens + sentence_tokens > token_budget:
+            continue
+        selected.append(index)
+        used_tokens += sentence_tokens
+    if not selected:
+        return truncate_text(sentences[0], token_budget * 4)
+    return ' '.join(sentences[index] for index in sorted(selected))
+
+NEXT_KEY_PATTERN = re.compile(r'\s*(?:"[^"\n]{1,60}"|\'[^\'\n]{1,60}\'|[A-Za-z_]\w{0,59})\s*:')
+JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+def repair_json(text):
+    # Tolerant single-pass JSON reader for LLM output. Skips code fences and chatter before the first
+    # { or [, accepts trailing or missing commas, single-quoted and bare keys, raw newlines and stray
+    # unescaped quotes inside strings, and returns whatever was complete when truncated output ends.
+    # Returns None when no object or array is found.
+    text = text or ''
+    starts = [index for index in (text.find('{'), text.find('[')) if index >= 0]
+    if not starts:
+        return None
+    position = [min(starts)]
+    length = len(text)
+
+    def peek_non_space(index):
+        while index < length and text[index].isspace():
+            index += 1
+        return text[index] if index < length else ''
+
+    def skip_space():
+        while position[0] < length and text[position[0]].isspace():
+            position[0] += 1
+
+    def parse_string(quote, is_key):
+        position[0] += 1
+        chars = []
+        while position[0] < length:
+            char = text[position[0]]
+            if char == '\\':
+                escape = text[position[0] + 1:position[0] + 2]
+                if escape == 'u':
+                    digits = text[position[0] + 2:position[0] + 6]
+                    if len(digits) < 4:
+                        position[0] = length
+                        break
+                    try:
+                        chars.append(chr(int(digits, 16)))
+                    except ValueError:
+                        chars.append(digits)
+                    position[0] += 6
+                    continue
+                if not escape:
+                    position[0] = length
+                    break
+                chars.append(JSON_ESCAPES.get(escape, escape))
+                position[0] += 2
+                continue
+            if char == quote:
+                following = peek_non_space(position[0] + 1)
+                if is_key and following in (':', ''):
+                    position[0] += 1
+                    return ''.join(chars)
+                if not is_key:
+                    if following in ('}', ']', ''):
+                        position[0] += 1
+                        return ''.join(chars)
+                    if following == ',':
+                        comma = text.index(',', position[0] + 1)
+                        if peek_non_space(comma + 1) in ('"', "'", '}', ']', '{', '[', '') or NEXT_KEY_PATTERN.match(text, comma + 1):
+                            position[0] += 1
+                            return ''.join(chars)
+                    elif NEXT_KEY_PATTERN.match(text, position[0] + 1):
+                        # Missing comma between two members.
+                        position[0] += 1
+                        return ''.join(chars)
+                # A quote that is not followed by a delimiter is part of the text.
+            chars.append(char)
+            position[0] += 1
+        return ''.join(chars)
+
+    def parse_bare_word():
+        start = position[0]
+        while position[0] < length and text[position[0]] not in ',:}]\n':
+            position[0] += 1
+        word = text[start:position[0]].strip()
+        literals = {'true': True, 'false': False, 'null': None}
+        if word in literals:
+            return literals[word]
+        try:
+            return int(word)
+        except ValueError:
+            pass
+        try:
+            return float(word)
+        except ValueError:
+            return word
+
+    def parse_value():
+        skip_space()
+        if position[0] >= length:
+            return None
+        char = text[position[0]]
+        if char == '{':
+            return parse_object()
+        if char == '[':
+            return parse_array()
+        if char in ('"', "'"):
+            return parse_string(char, False)
+        return parse_bare_word()
+
+    def parse_object():
+        position[0] += 1
+        result = {}
+        while True:
+            skip_space()
+            while position[0] < length and text[position[0]] == ',':
+                position[0] += 1
+                skip_space()
+            if position[0] >= length:
+                return result
+            char = text[position[0]]
+            if char in '}]':
+                position[0] += 1
+                return result
+            if char in ('"', "'"):
+                key = parse_string(char, True)
+            else:
+                start = position[0]
+                while position[0] < length and text[position[0]] not in ':,}':
+                    position[0] += 1
+                key = text[start:position[0]].strip()
+            skip_space()
+            if position[0] < length and text[position[0]] == ':':
+                position[0] += 1
+            if position[0] >= length:
+                return result
+            result[key] = parse_value()
+
+    def parse_array():
+        position[0] += 1
+        result = []
+        while True:
+            skip_space()
+            while position[0] < length and text[position[0]] == ',':
+                position[0] += 1
+                skip_space()
+            if position[0] >= length:
+                return result
+            if text[position[0]] in ']}':
+                position[0] += 1
+                return result
+            before = position[0]
+            result.append(parse_value())
+            if position[0] == before:
+                position[0] += 1
+
+    return parse_value()
+
 def partial_parse_json(response, context):
     try:
         cleaned_response = response.strip().strip('"\'')
         data = json.loads(cleaned_response)
         return data
     except json.JSONDecodeError as e:
-        context.log(f"Full JSON parsing failed: {str(e)}. Attempting partial parsing.")
+        context.log(f"Full JSON parsing failed: {str(e)}. Attempting repair parsing.")
         try:
-            title_match = re.search(r'"title"\s*:\s*"([^"]+)"', response)
-            summary_match = re.search(r'"summary"\s*:\s*"([^"]+)"', response)
-            explanation_match = re.search(r'"full_explanation"\s*:\s*"([^"]+)"', response)
-            category_match = re.search(r'"category"\s*:\s*"([^"]+)"', response)
-            tags_match = re.search(r'"tags"\s*:\s*\[([^\]]*)\]', response)
-
+            data = repair_json(response)
+            if not isinstance(data, dict):
+                return None
             result = {}
-            if title_match:
-                result['title'] = title_match.group(1)[:255]
-            if summary_match:
-                result['summary'] = summary_match.group(1)[:100]
-            if explanation_match:
-                result['full_explanation'] = explanation_match.group(1)
-            if category_match:
-                result['category'] = category_match.group(1)
-            if tags_match:
-                tags = [tag.strip().strip('"') for tag in tags_match.group(1).split(',') if tag.strip()]
+            if isinstance(data.get('title'), str):
+                result['title'] = data['title'][:255]
+            if isinstance(data.get('summary'), str):
+                result['summary'] = data['summary'][:100]
+            if isinstance(data.get('full_explanation'), str):
+                result['full_explanation'] = data['full_explanation']
+            if isinstance(data.get('category'), str):
+                result['category'] = data['category'].strip()
+            if isinstance(data.get('tags'), list):
+                tags = [str(tag).strip() for tag in data['tags'] if tag is not None and str(tag).strip()]
                 result['tags'] = tags if 3 <= len(tags) <= 5 else None
 
             if result:
-                context.log(f"Partially parsed JSON: {json.dumps(result, ensure_ascii=False)}")
+                context.log(f"Partially parsed JSON: {json.dumps(result, ensure_ascii=False)[:500]}")
                 return result
         except Exception as e:
             context.log(f"Partial JSON parsing failed: {str(e)}")
     return None
 
-def refine_article_with_ai(original_title, original_summary, full_explanation, feed_name, context):
-    prompt = (
+# Bump whenever the prompt or validation changes so cached LLM results from the old prompt are not reused.
+PROMPT_VERSION = 'refine-v1'
+
+REFINE_INSTRUCTIONS = (
+    "1. Translate the title (if in English) or regenerate it (if in Persian) to a concise, accurate Persian title (max 255 characters). "
+    "2. Translate the summary (if in English) or regenerate it (if in Persian) to a concise Persian summary (max 100 characters). "
+    "3. Summarize the scraped content to produce a complete and coherent Persian explanation relevant to the title and summary. "
+    "   - When translating from other languages to Persian, if it's a person or place name, include the original name in parentheses, e.g., رئیس جمهور ترامپ (`Trump`). "
+    "   - The summary must be 1500–2000 characters long, unless the content is insufficient, then use all relevant content. "
+    "   - Ensure the summary ends naturally, not mid-sentence, and covers key details without omitting critical information. "
+    "   - Remove irrelevant parts (e.g., advertisements, navigation menus) and translate to Persian if necessary. "
+    "4. Assign a category in Persian from this list: سیاست, اقتصاد, فناوری, سلامت, ورزش, سرگرمی, جهان, based on the content. "
+    "5. Generate 3-5 relevant Persian tags (e.g., 'هسته‌ای', 'اقتصاد جهانی') based on the content. "
+)
+REFINE_EXAMPLE = (
+    '{\n'
+    '  "title": "وزیر آفریقای جنوبی اتهامات بی‌اساس را رد کرد",\n'
+    '  "summary": "وزیر پلیس ادعاهای نادرست را تکذیب کرد.",\n'
+    '  "full_explanation": "وزیر پلیس آفریقای جنوبی اظهارات مطرح شده درباره وقایع اخیر را نادرست خواند و اطلاعات دقیقی ارائه کرد... (1500–2000 characters)",\n'
+    '  "category": "جهان",\n'
+    '  "tags": ["آفریقای جنوبی", "سیاست", "خبر بین‌المللی", "وزیر پلیس"]\n'
+    '}'
+)
+
+def build_refine_prompt(original_title, original_summary, full_explanation, feed_name):
+    return (
         f"You are processing a news article from {feed_name}. "
         f"Based on the provided title, summary, and scraped content, perform the following: "
-        f"1. Translate the title (if in English) or regenerate it (if in Persian) to a concise, accurate Persian title (max 255 characters). "
-        f"2. Translate the summary (if in English) or regenerate it (if in Persian) to a concise Persian summary (max 100 characters). "
-        f"3. Summarize the scraped content to produce a complete and coherent Persian explanation relevant to the title and summary. "
-        f"   - When translating from other languages to Persian, if it's a person or place name, include the original name in parentheses, e.g., رئیس جمهور ترامپ (`Trump`). "
-        f"   - The summary must be 1500–2000 characters long, unless the content is insufficient, then use all relevant content. "
-        f"   - Ensure the summary ends naturally, not mid-sentence, and covers key details without omitting critical information. "
-        f"   - Remove irrelevant parts (e.g., advertisements, navigation menus) and translate to Persian if necessary. "
-        f"4. Assign a category in Persian from this list: سیاست, اقتصاد, فناوری, سلامت, ورزش, سرگرمی, جهان, based on the content. "
-        f"5. Generate 3-5 relevant Persian tags (e.g., 'هسته‌ای', 'اقتصاد جهانی') based on the content. "
+        f"{REFINE_INSTRUCTIONS}"
         f"Return a valid JSON object with keys: title (string), summary (string), full_explanation (string), category (string), tags (array of strings). "
         f"The response must be properly formatted JSON, enclosed in {{}}, with no markdown code blocks (e.g., ```json). "
         f"Example JSON format:\n"
-        f'{{\n'
-        f'  "title": "وزیر آفریقای جنوبی اتهامات بی‌اساس را رد کرد",\n'
-        f'  "summary": "وزیر پلیس ادعاهای نادرست را تکذیب کرد.",\n'
-        f'  "full_explanation": "وزیر پلیس آفریقای جنوبی اظهارات مطرح شده درباره وقایع اخیر را نادرست خواند و اطلاعات دقیقی ارائه کرد... (1500–2000 characters)",\n'
-        f'  "category": "جهان",\n'
-        f'  "tags": ["آفریقای جنوبی", "سیاست", "خبر بین‌المللی", "وزیر پلیس"]\n'
-        f'}}'
+        f"{REFINE_EXAMPLE}"
         f"\n\nOriginal Title: {original_title}\n"
         f"Original Summary: {original_summary}\n"
         f"Scraped Content: {full_explanation}\n\n"
         f"Output only the JSON object, no additional text or markdown."
     )
 
-    # Gemini API Attempt
-    gemini_api_key = os.environ.get('GEMINI_API_KEY')
-    if not gemini_api_key:
-        context.log("GEMINI_API_KEY not found. Skipping Gemini API.")
-    else:
-        context.log(f"Calling Gemini API for article: {original_title}")
-        start_time = time.time()
-        try:
-            genai.configure(api_key=gemini_api_key)
-            model = genai.GenerativeModel('gemini-1.5-flash')
-            response = model.generate_content(prompt)
-            elapsed_time = time.time() - start_time
-            context.log(f"Gemini API response time: {elapsed_time:.2f} seconds")
-            ai_response = response.text.strip()
-            ai_response = re.sub(r'^```json\s*|\s*```$', '', ai_response).strip()
-            context.log(f"Gemini API raw response (first 500 chars): {ai_response[:500]}")
-            try:
-                refined_data = json.loads(ai_response)
-                tags = refined_data.get('tags', ["خبر", "جهان", feed_name.lower().replace(" ", "_")])
-                if not isinstance(tags, list) or len(tags) < 3 or len(tags) > 5:
-                    tags = ["خبر", "جهان", feed_name.lower().replace(" ", "_")]
-                full_explanation = refined_data.get('full_explanation', '')
-                if not full_explanation or len(full_explanation) < 500:
-                    context.log(f"Gemini API full_explanation invalid or too short ({len(full_explanation)} chars). Trying next API.")
-                    raise ValueError("Invalid full_explanation")
-                context.log("Gemini API succeeded")
-                return {
-                    "title": refined_data.get('title', original_title)[:255],
-                    "summary": refined_data.get('summary', original_summary)[:100],
-                    "full_explanation": full_explanation,
-                    "category": refined_data.get('category', "جهان"),
-                    "tags": tags
-                }
-            except json.JSONDecodeError:
-                refined_data = partial_parse_json(ai_response, context)
-                if refined_data:
-                    tags = refined_data.get('tags', ["خبر", "جهان", feed_name.lower().replace(" ", "_")])
-                    if not tags or len(tags) < 3 or len(tags) > 5:
-                        tags = ["خبر", "جهان", feed_name.lower().replace(" ", "_")]
-                    full_explanation = refined_data.get('full_explanation', '')
-                    if not full_explanation or len(full_explanation) < 500:
-                        context.log(f"Gemini API full_explanation invalid or too short ({len(full_explanation)} chars). Trying next API.")
-                        raise ValueError("Invalid full_explanation")
-                    context.log("Gemini API succeeded with partial JSON parsing")
-                    return {
-                        "title": refined_data.get('title', original_title)[:255],
-                        "summary": refined_data.get('summary', original_summary)[:100],
-                        "full_explanation": full_explanation,
-                        "category": refined_data.get('category', "جهان"),
-                        "tags": tags
-                    }
-                context.log("Gemini API JSON parsing failed. Trying next API.")
-                raise ValueError("JSON parsing failed")
-        except Exception as e:
-            elapsed_time = time.time() - start_time
-            context.log(f"Gemini API call failed for '{original_title}': {str(e)}. Response time: {elapsed_time:.2f} seconds. Trying next API.")
-
-    # OpenRouter API Attempts
-    openrouter_api_keys = [
-        os.environ.get('OPENROUTER_API_KEY_1'),
-        os.environ.get('OPENROUTER_API_KEY_2'),
-        os.environ.get('OPENROUTER_API_KEY_3')
-    ]
-    openrouter_api_keys = [key for key in openrouter_api_keys if key]  # Remove None values
+REFINE_FIELD_INSTRUCTIONS = {
+    'title': "title: translate the title (if in English) or regenerate it (if in Persian) to a concise, accurate Persian title (max 255 characters). ",
+    'summary': "summary: translate the summary (if in English) or regenerate it (if in Persian) to a concise Persian summary (max 100 characters). ",
+    'full_explanation': (
+        "full_explanation: summarize the scraped content into a complete and coherent Persian explanation of 1500–2000 characters "
+        "relevant to the title and summary, ending naturally, not mid-sentence. Remove irrelevant parts (e.g., advertisements, "
+        "navigation menus); for person or place names translated to Persian, include the original name in parentheses. "
+    ),
+    'category': "category: one category in Persian from this list: سیاست, اقتصاد, فناوری, سلامت, ورزش, سرگرمی, جهان, based on the content. ",
+    'tags': "tags: 3-5 relevant Persian tags (e.g., 'هسته‌ای', 'اقتصاد جهانی') based on the content. "
+}
 
-    if not openrouter_api_keys:
-        context.log("No OPENROUTER_API_KEYs found. Skipping OpenRouter API.")
-    else:
-        for idx, api_key in enumerate(openrouter_api_keys, 1):
-            openrouter_url = "https://openrouter.ai/api/v1/chat/completions"
-            openrouter_headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
-            openrouter_payload = {
-                "model": "meta-llama/llama-4-maverick:free",
-                "messages": [{"role": "user", "content": prompt}]
-            }
-
-            context.log(f"Calling OpenRouter API (Attempt {idx}) for article: {original_title}")
-            start_time = time.time()
-            try:
-                response = requests.post(openrouter_url, headers=openrouter_headers, json=openrouter_payload, timeout=5)
-                response.raise_for_status()
-                elapsed_time = time.time() - start_time
-                context.log(f"OpenRouter (Attempt {idx}) response time: {elapsed_time:.2f} seconds")
-                result = response.json()
-                ai_response = result.get('choices', [{}])[0].get('message', {}).get('content', '{}')
-                context.log(f"OpenRouter (Attempt {idx}) raw response (first 500 chars): {ai_response[:500]}")
-                ai_response = ai_response.strip().encode('utf-8').decode('utf-8')
-                try:
-                    refined_data = json.loads(ai_response)
-                    tags = refined_data.get('tags', ["خبر", "جهان", feed_name.lower().replace(" ", "_")])
-                    if not isinstance(tags, list) or len(tags) < 3 or len(tags) > 5:
-                        tags = ["خبر", "جهان", feed_name.lower().replace(" ", "_")]
-                    full_explanation = refined_data.get('full_explanation', '')
-                    if not full_explanation or len(full_explanation) < 500:
-                        context.log(f"OpenRouter (Attempt {idx}) full_explanation invalid or too short ({len(full_explanation)} chars). Trying next API.")
-                        continue
-                    context.log(f"OpenRouter (Attempt {idx}) succeeded")
-                    return {
-                        "title": refined_data.get('title', original_title)[:255],
-                        "summary": refined_data.get('summary', original_summary)[:100],
-                        "full_explanation": full_explanation,
-                        "category": refined_data.get('category', "جهان"),
-                        "tags": tags
-                    }
-                except json.JSONDecodeError:
-                    refined_data = partial_parse_json(ai_response, context)
-                    if refined_data:
-                        tags = refined_data.get('tags', ["خبر", "جهان", feed_name.lower().replace(" ", "_")])
-                        if not tags or len(tags) < 3 or len(tags) > 5:
-                            tags = ["خبر", "جهان", feed_name.lower().replace(" ", "_")]
-                        full_explanation = refined_data.get('full_explanation', '')
-                        if not full_explanation or len(full_explanation) < 500:
-                            context.log(f"OpenRouter (Attempt {idx}) full_explanation invalid or too short ({len(full_explanation)} chars). Trying next API.")
-                            continue
-                        context.log(f"OpenRouter (Attempt {idx}) succeeded with partial JSON parsing")
-                        return {
-                            "title": refined_data.get('title', original_title)[:255],
-                            "summary": refined_data.get('summary', original_summary)[:100],
-                            "full_explanation": full_explanation,
-                            "category": refined_data.get('category', "جهان"),
-                            "tags": tags
-                        }
-                    context.log(f"OpenRouter (Attempt {idx}) JSON parsing failed. Trying next API.")
-                    continue
-            except Exception as e:
-                elapsed_time = time.time() - start_time
-                context.log(f"OpenRouter (Attempt {idx}) API call failed for '{original_title}': {str(e)}. Response time: {elapsed_time:.2f} seconds. Trying next API.")
-                continue
+def build_fields_refine_prompt(original_title, original_summary, full_explanation, feed_name, fields):
+    # Used by the two-phase mode, which asks for the short fields first and full_explanation separately.
+    return (
+        f"You are processing a news article from {feed_name}. "
+        f"Based on the provided title, summary, and scraped content, return a valid JSON object with only these keys: {', '.join(fields)}. "
+        + ''.join(REFINE_FIELD_INSTRUCTIONS[field] for field in fields)
+        + f"\n\nOriginal Title: {original_title}\n"
+        f"Original Summary: {original_summary}\n"
+        f"Scraped Content: {full_explanation}\n\n"
+        f"Output only the JSON object, no additional text or markdown."
+    )
 
-    # Aval AI API Attempt
-    avalai_api_key = os.environ.get('AVALAI_API_KEY')
-    if not avalai_api_key:
-        context.log("AVALAI_API_KEY not found. Skipping article.")
-        return None
+def build_batch_refine_prompt(items, fields=None):
+    # One shared instruction preamble followed by every article, answered as a JSON array in the same order.
+    # A narrower fields list (category and tags left to the local classifier) swaps in per-field instructions.
+    articles = ''.join(
+        f"\n\nArticle {index} (source: {item['feed_name']}):\n"
+        f"Original Title: {item['original_title']}\n"
+        f"Original Summary: {item['original_summary']}\n"
+        f"Scraped Content: {item['full_explanation']}"
+        for index, item in enumerate(items, 1)
+    )
+    if fields and fields != REFINED_KEY_ORDER:
+        return (
+            f"You are processing {len(items)} news articles. "
+            f"Return a valid JSON array with exactly {len(items)} objects, one per article and in the same order. "
+            f"Each object has keys: id (the article number), {', '.join(fields)}. "
+            + ''.join(REFINE_FIELD_INSTRUCTIONS[field] for field in fields)
+            + f"{articles}\n\n"
+            f"Output only the JSON array, no additional text or markdown."
+        )
+    return (
+        f"You are processing {len(items)} news articles. "
+        f"For each article, based on its title, summary, and scraped content, perform the following: "
+        f"{REFINE_INSTRUCTIONS}"
+        f"Return a valid JSON array with exactly {len(items)} objects, one per article and in the same order. "
+        f"Each object has keys: id (the article number), title (string), summary (string), full_explanation (string), category (string), tags (array of strings). "
+        f"The response must be properly formatted JSON, enclosed in [], with no markdown code blocks (e.g., ```json). "
+        f"Example object format:\n"
+        f"{REFINE_EXAMPLE}"
+        f"{articles}\n\n"
+        f"Output only the JSON array, no additional text or markdown."
+    )
+
+# Default chain, used when neither LLM_PROVIDERS (inline JSON) nor LLM_PROVIDERS_FILE (path to a JSON file)
+# is set. Each entry needs a name and a type from PROVIDER_BACKENDS; the key is read from api_key_env
+# (or given inline as api_key) and entries without a key are skipped. openai entries take a url and
+# may add headers and extra_body fields, so any OpenAI-compatible endpoint can be added from config.
+# structured_output is json_schema, json_object or none (the default for openai entries, gemini uses
+# json_schema); LLM_STRUCTURED_OUTPUT=0 turns it off everywhere. fast_model, if set, replaces model for the
+# short headline call of the two-phase mode (TWO_PHASE_PUBLISH=1). local entries talk to a self-hosted
+# OpenAI-compatible server and need no key; setting LOCAL_LLM_URL puts one at the front of the default chain.
+DEFAULT_PROVIDER_CHAIN = [
+    {"name": "Gemini", "type": "gemini", "model": "gemini-1.5-flash", "fast_model": "gemini-1.5-flash-8b", "api_key_env": "GEMINI_API_KEY"},
+    {"name": "OpenRouter (Attempt 1)", "type": "openai", "url": "https://openrouter.ai/api/v1/chat/completions",
+     "model": "meta-llama/llama-4-maverick:free", "api_key_env": "OPENROUTER_API_KEY_1", "timeout": 5},
+    {"name": "OpenRouter (Attempt 2)", "type": "openai", "url": "https://openrouter.ai/api/v1/chat/completions",
+     "model": "meta-llama/llama-4-maverick:free", "api_key_env": "OPENROUTER_API_KEY_2", "timeout": 5},
+    {"name": "OpenRouter (Attempt 3)", "type": "openai", "url": "https://openrouter.ai/api/v1/chat/completions",
+     "model": "meta-llama/llama-4-maverick:free", "api_key_env": "OPENROUTER_API_KEY_3", "timeout": 5},
+    {"name": "Aval AI", "type": "openai", "url": "https://api.avalai.ir/v1/chat/completions",
+     "model": "gpt-4o-mini", "api_key_env": "AVALAI_API_KEY", "timeout": 10, "structured_output": "json_schema"},
+]
+
+REFINED_KEY_ORDER = ['title', 'summary', 'full_explanation', 'category', 'tags']
+HEADLINE_FIELDS = ['title', 'summary', 'category', 'tags']
+EXPLANATION_FIELDS = ['full_explanation']
+CLASSIFIED_FIELDS = ['category', 'tags']
+VALID_CATEGORIES = ['سیاست', 'اقتصاد', 'فناوری', 'سلامت', 'ورزش', 'سرگرمی', 'جهان']
+
+# The refined article shape, sent as the response schema to providers with structured output enabled.
+# Written as JSON Schema and converted per backend, since Gemini and OpenAI accept different subsets.
+REFINED_ARTICLE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string"},
+        "summary": {"type": "string"},
+        "full_explanation": {"type": "string"},
+        "category": {"type": "string", "enum": VALID_CATEGORIES},
+        "tags": {"type": "array", "items": {"type": "string"}, "minItems": 3, "maxItems": 5}
+    },
+    "required": REFINED_KEY_ORDER,
+    "additionalProperties": False
+}
+BATCH_REFINED_ARTICLES_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "articles": {
+            "type": "array",
+            "items": dict(
+                REFINED_ARTICLE_SCHEMA,
+                properties=dict({"id": {"type": "integer"}}, **REFINED_ARTICLE_SCHEMA['properties']),
+                required=['id'] + REFINED_KEY_ORDER
+            )
+        }
+    },
+    "required": ["articles"],
+    "additionalProperties": False
+}
+GEMINI_SCHEMA_FIELDS = {
+    'type': 'type', 'format': 'format', 'description': 'description', 'nullable': 'nullable', 'enum': 'enum',
+    'items': 'items', 'properties': 'properties', 'required': 'required', 'minItems': 'min_items', 'maxItems': 'max_items'
+}
+
+def get_structured_output_mode(provider):
+    # 'json_schema' sends REFINED_ARTICLE_SCHEMA, 'json_object' only asks for JSON, 'none' relies on the prompt.
+    if os.environ.get('LLM_STRUCTURED_OUTPUT', '1') == '0':
+        return 'none'
+    return provider.get('structured_output') or ('json_schema' if provider['type'] in ('gemini', 'local') else 'none')
+
+def get_fields_schema(fields):
+    if fields == REFINED_KEY_ORDER:
+        return REFINED_ARTICLE_SCHEMA
+    return dict(
+        REFINED_ARTICLE_SCHEMA,
+        properties={field: REFINED_ARTICLE_SCHEMA['properties'][field] for field in fields},
+        required=fields
+    )
+
+def get_batch_fields_schema(fields):
+    if fields == REFINED_KEY_ORDER:
+        return BATCH_REFINED_ARTICLES_SCHEMA
+    item_schema = BATCH_REFINED_ARTICLES_SCHEMA['properties']['articles']['items']
+    articles_schema = dict(
+        BATCH_REFINED_ARTICLES_SCHEMA['properties']['articles'],
+        items=dict(
+            item_schema,
+            properties={field: item_schema['properties'][field] for field in ['id'] + fields},
+            required=['id'] + fields
+        )
+    )
+    return dict(BATCH_REFINED_ARTICLES_SCHEMA, properties={'articles': articles_schema})
+
+def to_gemini_schema(schema):
+    # Gemini takes an OpenAPI subset: no additionalProperties, snake_case item bounds and enums marked by format.
+    converted = {}
+    for key, value in schema.items():
+        if key not in GEMINI_SCHEMA_FIELDS:
+            continue
+        if key == 'items':
+            value = to_gemini_schema(value)
+        elif key == 'properties':
+            value = {name: to_gemini_schema(field) for name, field in value.items()}
+        converted[GEMINI_SCHEMA_FIELDS[key]] = value
+    if 'enum' in schema:
+        converted['format'] = 'enum'
+    return converted
 
-    avalai_url = "https://api.avalai.ir/v1/chat/completions"
-    avalai_headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {avalai_api_key}"
+def to_openai_schema(schema):
+    # Strict mode needs every property required and rejects array length bounds; validation enforces those instead.
+    converted = {key: value for key, value in schema.items() if key not in ('minItems', 'maxItems')}
+    if 'items' in schema:
+        converted['items'] = to_openai_schema(schema['items'])
+    if 'properties' in schema:
+        converted['properties'] = {name: to_openai_schema(field) for name, field in schema['properties'].items()}
+    return converted
+
+class StreamAborted(Exception):
+    pass
+
+def new_stream_guard(min_explanation_chars=500):
+    return {
+        'min_explanation_chars': min_explanation_chars, 'parts': [], 'length': 0, 'prefix': '', 'started': False, 'complete': False,
+        'depth': 0, 'in_string': False, 'escape': False, 'unicode_digits': 0, 'expecting_key': False, 'string_is_key': False,
+        'key_chars': [], 'current_key': None, 'value_key': None, 'value_length': 0
     }
-    avalai_payload = {
-        "model": "gpt-4o-mini",
+
+def feed_stream_guard(guard, chunk):
+    # Scans streamed JSON one character at a time and raises StreamAborted only for answers the parser
+    # would reject too: no JSON object within STREAM_MAX_PREFIX_CHARS, a full_explanation shorter than
+    # min_explanation_chars, or a runaway output. Chatter before the object and any key order are left to repair_json.
+    # Sets guard['complete'] once the top-level object closes so the caller can stop reading.
+    # Lengths are of the decoded text: an escape sequence such as \n or \u0627 counts as one character.
+    guard['parts'].append(chunk)
+    for position, char in enumerate(chunk):
+        if guard['complete']:
+            # Drop whatever the model sent after the closing brace.
+            guard['parts'][-1] = chunk[:position]
+            return
+        if guard['unicode_digits']:
+            guard['unicode_digits'] -= 1
+            continue
+        if not (guard['in_string'] and guard['escape']):
+            guard['length'] += 1
+            if guard['length'] > get_int_env('STREAM_MAX_CHARS', 12000):
+                raise StreamAborted(f"runaway output over {guard['length']} chars")
+        if not guard['started']:
+            if char == '{':
+                guard.update(started=True, depth=1, expecting_key=True)
+                continue
+            guard['prefix'] += char
+            if len(guard['prefix']) > get_int_env('STREAM_MAX_PREFIX_CHARS', 1000):
+                raise StreamAborted(f"no JSON object in the first {len(guard['prefix'])} chars")
+            continue
+        if guard['in_string']:
+            if guard['escape']:
+                guard['escape'] = False
+                if char == 'u':
+                    guard['unicode_digits'] = 4
+            elif char == '\\':
+                guard['escape'] = True
+                continue
+            elif char == '"':
+                close_stream_string(guard)
+                continue
+            if guard['string_is_key']:
+                guard['key_chars'].append(char)
+            elif guard['value_key'] == 'full_explanation':
+                guard['value_length'] += 1
+                if guard['value_length'] > get_int_env('STREAM_MAX_EXPLANATION_CHARS', 6000):
+                    raise StreamAborted(f"runaway full_explanation over {guard['value_length']} chars")
+            continue
+        if char == '"':
+            guard['in_string'] = True
+            guard['string_is_key'] = guard['depth'] == 1 and guard['expecting_key']
+            guard['key_chars'] = []
+            guard['value_length'] = 0
+        elif char in '{[':
+            guard['depth'] += 1
+        elif char in '}]':
+            guard['depth'] -= 1
+            if guard['depth'] == 0:
+                guard['complete'] = True
+        elif char == ',' and guard['depth'] == 1:
+            guard.update(expecting_key=True, value_key=None)
+        elif char == ':' and guard['depth'] == 1:
+            guard.update(expecting_key=False, value_key=guard['current_key'])
+
+def close_stream_string(guard):
+    guard['in_string'] = False
+    if guard['string_is_key']:
+        guard['current_key'] = ''.join(guard['key_chars'])
+    elif guard['value_key'] == 'full_explanation' and guard['depth'] == 1 and guard['value_length'] < guard['min_explanation_chars']:
+        raise StreamAborted(f"full_explanation too short ({guard['value_length']} chars)")
+
+def is_streaming_enabled(provider):
+    return bool(provider.get('stream', os.environ.get('LLM_STREAMING', '0') == '1'))
+
+# genai.configure sets the API key SDK-wide and a model binds its client on its first request, so
+# configuring and sending are done under one lock to keep concurrent Gemini entries on their own keys.
+GEMINI_CONFIG_LOCK = threading.Lock()
+
+def complete_with_gemini(provider, prompt, stream_guard=None, response_schema=None):
+    request_options = {'timeout': provider['timeout']} if provider.get('timeout') else None
+    generation_config = None
+    mode = get_structured_output_mode(provider)
+    if mode in ('json_schema', 'json_object'):
+        generation_config = {'response_mime_type': 'application/json'}
+        if mode == 'json_schema' and response_schema:
+            generation_config['response_schema'] = to_gemini_schema(response_schema)
+    with GEMINI_CONFIG_LOCK:
+        genai.configure(api_key=provider['api_key'])
+        model = genai.GenerativeModel(provider.get('model', 'gemini-1.5-flash'))
+        if stream_guard is None:
+            response = model.generate_content(prompt, generation_config=generation_config, request_options=request_options)
+            return response.text
+        # The streamed chunks are read outside the lock; the request already carries this entry's key.
+        response = model.generate_content(prompt, stream=True, generation_config=generation_config, request_options=request_options)
+    for chunk in response:
+        feed_stream_guard(stream_guard, chunk.text)
+        if stream_guard['complete']:
+            break
+    return ''.join(stream_guard['parts'])
+
+def complete_with_openai_compatible(provider, prompt, stream_guard=None, response_schema=None):
+    headers = {"Content-Type": "application/json"}
+    if provider.get('api_key'):
+        headers["Authorization"] = f"Bearer {provider['api_key']}"
+    headers.update(provider.get('headers') or {})
+    payload = {
+        "model": provider['model'],
         "messages": [{"role": "user", "content": prompt}]
     }
+    mode = get_structured_output_mode(provider)
+    if mode == 'json_schema' and response_schema:
+        payload["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "refined_article", "strict": True, "schema": to_openai_schema(response_schema)}
+        }
+    elif mode in ('json_schema', 'json_object'):
+        payload["response_format"] = {"type": "json_object"}
+    payload.update(provider.get('extra_body') or {})
+    if stream_guard is None:
+        response = requests.post(provider['url'], headers=headers, json=payload, timeout=provider.get('timeout', 10))
+        response.raise_for_status()
+        result = response.json()
+        return result.get('choices', [{}])[0].get('message', {}).get('content', '{}')
+
+    payload['stream'] = True
+    with requests.post(provider['url'], headers=headers, json=payload, timeout=provider.get('timeout', 10), stream=True) as response:
+        response.raise_for_status()
+        # Server-sent events: one "data: {...}" line per delta, terminated by "data: [DONE]".
+        for line in response.iter_lines():
+            line = line.decode('utf-8', errors='replace').strip()
+            if not line.startswith('data:'):
+                continue
+            data = line[5:].strip()
+            if data == '[DONE]':
+                break
+            choices = json.loads(data).get('choices') or [{}]
+            delta = choices[0].get('delta', {}).get('content')
+            if delta:
+                feed_stream_guard(stream_guard, delta)
+                if stream_guard['complete']:
+                    break
+    return ''.join(stream_guard['parts'])
+
+def complete_with_local(provider, prompt, stream_guard=None, response_schema=None):
+    # Self-hosted OpenAI-compatible server such as llama.cpp or vLLM on CPU: no key, a long timeout,
+    # greedy decoding with a fixed seed so repeated runs give the same answer, and LOCAL_LLM_CONCURRENCY
+    # requests at a time since a CPU server mostly works through them one by one anyway.
+    local_provider = dict(provider)
+    local_provider.setdefault('url', os.environ.get('LOCAL_LLM_URL', 'http://127.0.0.1:8080/v1/chat/completions'))
+    local_provider.setdefault('model', os.environ.get('LOCAL_LLM_MODEL', 'local'))
+    local_provider.setdefault('timeout', get_float_env('LOCAL_LLM_TIMEOUT', 120))
+    local_provider['extra_body'] = dict({'temperature': 0, 'seed': 0}, **(provider.get('extra_body') or {}))
+    with stage_slot('local_llm'):
+        return complete_with_openai_compatible(local_provider, prompt, stream_guard, response_schema)
+
+PROVIDER_BACKENDS = {
+    'gemini': complete_with_gemini,
+    'openai': complete_with_openai_compatible,
+    'local': complete_with_local
+}
+
+def load_provider_chain(context):
+    chain = DEFAULT_PROVIDER_CHAIN
+    try:
+        if os.environ.get('LLM_PROVIDERS'):
+            chain = json.loads(os.environ['LLM_PROVIDERS'])
+        elif os.environ.get('LLM_PROVIDERS_FILE'):
+            with open(os.environ['LLM_PROVIDERS_FILE'], encoding='utf-8') as config_file:
+                chain = json.load(config_file)
+    except Exception as e:
+        context.log(f"Failed to load LLM provider config: {str(e)}. Using default provider chain.")
+        chain = DEFAULT_PROVIDER_CHAIN
+    if chain is DEFAULT_PROVIDER_CHAIN and os.environ.get('LOCAL_LLM_URL'):
+        chain = [{"name": "Local LLM", "type": "local", "url": os.environ['LOCAL_LLM_URL']}] + chain
+
+    providers = []
+    for entry in chain:
+        if not isinstance(entry, dict) or entry.get('enabled') is False:
+            continue
+        name = entry.get('name') or entry.get('model') or entry.get('type')
+        if entry.get('type') not in PROVIDER_BACKENDS:
+            context.log(f"Unknown provider type '{entry.get('type')}' for {name}. Skipping.")
+            continue
+        api_key = entry.get('api_key') or (os.environ.get(entry['api_key_env']) if entry.get('api_key_env') else None)
+        if entry.get('api_key_env') and not api_key:
+            context.log(f"{entry['api_key_env']} not found. Skipping {name}.")
+            continue
+        provider = dict(entry)
+        provider['name'] = name
+        provider['api_key'] = api_key
+        providers.append(provider)
+    return providers
+
+PROVIDER_STATS_LOCK = threading.Lock()
+
+def get_provider_id(provider):
+    return provider.get('id') or provider['name']
 
-    context.log(f"Calling Aval AI API (Final attempt) for article: {original_title}")
+def get_provider_stats_id(provider, batch=False):
+    # A batch call takes several times as long as a single-article call, so its stats are kept apart.
+    return f"{get_provider_id(provider)}:batch" if batch else get_provider_id(provider)
+
+def load_provider_stats(provider_id):
+    rows = state_db_execute(
+        "SELECT successes, attempts, latencies, updated_at FROM provider_stats WHERE provider_id = ?",
+        (provider_id,)
+    )
+    if not rows:
+        return {'successes': 0.0, 'attempts': 0.0, 'latencies': {'ok': [], 'fail': []}, 'updated_at': time.time()}
+    successes, attempts, latencies, updated_at = rows[0]
+    # Counts decay with PROVIDER_STATS_HALF_LIFE so an endpoint that recovers is not judged on stale failures.
+    decay = 0.5 ** (max(0.0, time.time() - updated_at) / max(1.0, get_float_env('PROVIDER_STATS_HALF_LIFE', 3600)))
+    latencies = json.loads(latencies or '{}')
+    if not isinstance(latencies, dict):
+        # Older rows kept one list for successes and failures together, which cannot be split again.
+        latencies = {}
+    return {
+        'successes': successes * decay,
+        'attempts': attempts * decay,
+        'latencies': {'ok': latencies.get('ok', []), 'fail': latencies.get('fail', [])},
+        'updated_at': updated_at
+    }
+
+def record_provider_outcome(provider, success, elapsed_time, context, batch=False):
+    provider_id = get_provider_stats_id(provider, batch)
+    try:
+        with PROVIDER_STATS_LOCK:
+            stats = load_provider_stats(provider_id)
+            latencies = stats['latencies']
+            outcome = 'ok' if success else 'fail'
+            latencies[outcome] = (latencies[outcome] + [round(elapsed_time, 3)])[-50:]
+            state_db_execute(
+                "INSERT OR REPLACE INTO provider_stats (provider_id, successes, attempts, latencies, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (provider_id, stats['successes'] + (1 if success else 0), stats['attempts'] + 1, json.dumps(latencies), time.time())
+            )
+    except Exception as e:
+        context.log(f"Failed to record stats for {provider_id}: {str(e)}")
+
+def get_latency_percentile(latencies, percentile):
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(round(percentile * (len(ordered) - 1))))]
+
+def estimate_time_to_valid_answer(stats):
+    # Beta(1, 1) prior on the success rate and one shared prior latency, so unexplored providers sit
+    # between healthy and degraded ones and keep their configured order among themselves.
+    # Each expected failure costs its own latency plus PROVIDER_RETRY_PENALTY before the next try.
+    success_rate = (stats['successes'] + 1) / (stats['attempts'] + 2)
+    prior_latency = get_float_env('PROVIDER_PRIOR_LATENCY', 5)
+    p50_ok = get_latency_percentile(stats['latencies']['ok'], 0.5)
+    if p50_ok is None:
+        p50_ok = prior_latency
+    p50_fail = get_latency_percentile(stats['latencies']['fail'], 0.5)
+    if p50_fail is None:
+        p50_fail = prior_latency
+    penalty = get_float_env('PROVIDER_RETRY_PENALTY', 2)
+    return p50_ok + (1 - success_rate) / success_rate * (p50_fail + penalty)
+
+def order_providers_by_expected_latency(providers, context, batch=False):
+    if os.environ.get('LLM_ADAPTIVE_ROUTING', '1') == '0' or len(providers) < 2:
+        return providers
+    try:
+        with PROVIDER_STATS_LOCK:
+            stats = {get_provider_id(provider): load_provider_stats(get_provider_stats_id(provider, batch)) for provider in providers}
+    except Exception as e:
+        context.log(f"Failed to load provider stats: {str(e)}. Using configured provider order.")
+        return providers
+    scores = {get_provider_id(provider): estimate_time_to_valid_answer(stats[get_provider_id(provider)]) for provider in providers}
+    positions = {get_provider_id(provider): index for index, provider in enumerate(providers)}
+    ordered = sorted(providers, key=lambda provider: (round(scores[get_provider_id(provider)], 3), positions[get_provider_id(provider)]))
+    if random.random() < get_float_env('PROVIDER_EXPLORE_RATE', 0.1):
+        explored = ordered.pop(random.randrange(len(ordered)))
+        ordered.insert(0, explored)
+    summary = []
+    for provider in ordered:
+        provider_stats = stats[get_provider_id(provider)]
+        p50 = get_latency_percentile(provider_stats['latencies']['ok'], 0.5)
+        p95 = get_latency_percentile(provider_stats['latencies']['ok'], 0.95)
+        summary.append(
+            f"{provider['name']} (expected {scores[get_provider_id(provider)]:.2f}s, "
+            f"success {provider_stats['successes']:.1f}/{provider_stats['attempts']:.1f}, "
+            f"p50 {p50 if p50 is not None else '-'}s, p95 {p95 if p95 is not None else '-'}s)"
+        )
+    context.log(f"Adaptive provider order: {'; '.join(summary)}")
+    return ordered
+
+def parse_ai_response(ai_response, context):
+    # Returns (data, partial) where partial tells whether the lenient fallback parser was needed.
+    ai_response = re.sub(r'^```(?:json)?\s*|\s*```$', '', (ai_response or '').strip()).strip()
+    try:
+        refined_data = json.loads(ai_response)
+        if isinstance(refined_data, dict):
+            return refined_data, False
+    except json.JSONDecodeError:
+        pass
+    return partial_parse_json(ai_response, context), True
+
+FIELD_REPAIR_INSTRUCTIONS = {
+    'full_explanation': (
+        "full_explanation: extend the current explanation into a complete and coherent Persian explanation of "
+        "1500–2000 characters using the source content below, ending naturally, not mid-sentence. "
+    ),
+    'category': "category: one category in Persian from this list: سیاست, اقتصاد, فناوری, سلامت, ورزش, سرگرمی, جهان. ",
+    'tags': "tags: 3-5 relevant Persian tags (e.g., 'هسته‌ای', 'اقتصاد جهانی'). "
+}
+
+def is_field_repair_enabled():
+    return os.environ.get('LLM_FIELD_REPAIR', '1') == '1'
+
+def find_invalid_fields(refined_data, fields=REFINED_KEY_ORDER):
+    invalid_fields = []
+    full_explanation = refined_data.get('full_explanation')
+    if 'full_explanation' in fields and (not isinstance(full_explanation, str) or len(full_explanation) < 500):
+        invalid_fields.append('full_explanation')
+    if 'category' in fields and refined_data.get('category') not in VALID_CATEGORIES:
+        invalid_fields.append('category')
+    tags = refined_data.get('tags')
+    if 'tags' in fields and (not isinstance(tags, list) or len(tags) < 3 or len(tags) > 5):
+        invalid_fields.append('tags')
+    return invalid_fields
+
+def build_field_repair_prompt(refined_data, fields, original_title, full_explanation):
+    current_explanation = refined_data.get('full_explanation')
+    prompt = (
+        f"You are fixing a Persian news article titled: {refined_data.get('title') or original_title}. "
+        f"Return a valid JSON object with only these keys: {', '.join(fields)}. "
+        + ''.join(FIELD_REPAIR_INSTRUCTIONS[field] for field in fields)
+    )
+    if isinstance(current_explanation, str) and current_explanation:
+        prompt += f"\n\nCurrent Explanation: {current_explanation}"
+    if 'full_explanation' in fields or not current_explanation:
+        prompt += f"\n\nSource Content: {full_explanation}"
+    return prompt + "\n\nOutput only the JSON object, no additional text or markdown."
+
+def repair_refined_fields(provider, refined_data, fields, original_title, full_explanation, context):
+    # Asks the same provider for just the invalid fields and merges what comes back, so a short explanation
+    # or a bad tag list costs one small follow-up call instead of a full regeneration on the next provider.
+    name = provider['name']
+    context.log(f"{name} answer for '{original_title}' has invalid {', '.join(fields)}. Requesting a repair.")
     start_time = time.time()
     try:
-        response = requests.post(avalai_url, headers=avalai_headers, json=avalai_payload, timeout=10)
-        response.raise_for_status()
+        prompt = build_field_repair_prompt(refined_data, fields, original_title, full_explanation)
+        ai_response = PROVIDER_BACKENDS[provider['type']](provider, prompt, None, get_fields_schema(fields))
+        repaired, _ = parse_ai_response(ai_response, context)
+    except Exception as e:
+        context.log(f"{name} field repair failed for '{original_title}': {str(e)}")
+        return refined_data
+    elapsed_time = time.time() - start_time
+    if not repaired:
+        context.log(f"{name} field repair returned no JSON. Response time: {elapsed_time:.2f} seconds")
+        return refined_data
+    merged = dict(refined_data)
+    merged.update({field: repaired[field] for field in fields if field in repaired})
+    still_invalid = [field for field in find_invalid_fields(merged) if field in fields]
+    context.log(
+        f"{name} field repair response time: {elapsed_time:.2f} seconds"
+        + (f", still invalid: {', '.join(still_invalid)}" if still_invalid else "")
+    )
+    return merged
+
+def validate_refined_data(refined_data, original_title, original_summary, feed_name, fields=REFINED_KEY_ORDER):
+    # Returns (article, error). Bad tags fall back to defaults; a short explanation rejects the answer.
+    # Fields outside fields were not requested and come back empty. Non-string values are treated as missing.
+    default_tags = ["خبر", "جهان", feed_name.lower().replace(" ", "_")]
+    tags = refined_data.get('tags') or default_tags
+    if not isinstance(tags, list) or len(tags) < 3 or len(tags) > 5 or not all(isinstance(tag, str) and tag for tag in tags):
+        tags = default_tags
+    full_explanation = refined_data.get('full_explanation') or ''
+    if not isinstance(full_explanation, str):
+        if 'full_explanation' in fields:
+            return None, f"full_explanation is not a string ({type(full_explanation).__name__})"
+        full_explanation = ''
+    if 'full_explanation' in fields and len(full_explanation) < 500:
+        return None, f"full_explanation invalid or too short ({len(full_explanation)} chars)"
+    title = refined_data.get('title')
+    summary = refined_data.get('summary')
+    category = refined_data.get('category')
+    return {
+        "title": (title if isinstance(title, str) and title.strip() else original_title)[:255],
+        "summary": (summary if isinstance(summary, str) and summary.strip() else original_summary)[:100],
+        "full_explanation": full_explanation,
+        "category": category if isinstance(category, str) and category else "جهان",
+        "tags": tags
+    }, None
+
+# Breaker state lives at module level, so it carries over between invocations served by a warm container.
+CIRCUIT_BREAKERS = {}
+CIRCUIT_BREAKERS_LOCK = threading.Lock()
+
+def is_rate_limit_error(error):
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None) == 429 or getattr(error, 'code', None) == 429 or type(error).__name__ == 'ResourceExhausted'
+
+def get_retry_after(error):
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+def acquire_circuit(provider, context):
+    provider_id = get_provider_id(provider)
+    with CIRCUIT_BREAKERS_LOCK:
+        breaker = CIRCUIT_BREAKERS.setdefault(provider_id, {'state': 'closed', 'failures': 0, 'opened_at': 0, 'cooldown': 0})
+        if breaker['state'] == 'closed':
+            return True
+        if breaker['state'] == 'open' and time.time() - breaker['opened_at'] >= breaker['cooldown']:
+            # Half-open: exactly one probe call goes through; its result closes or re-opens the breaker.
+            breaker['state'] = 'half_open'
+            context.log(f"Circuit for {provider_id} is half-open. Sending a probe request.")
+            return True
+    return False
+
+def record_circuit_result(provider, success, error, context):
+    provider_id = get_provider_id(provider)
+    with CIRCUIT_BREAKERS_LOCK:
+        breaker = CIRCUIT_BREAKERS.setdefault(provider_id, {'state': 'closed', 'failures': 0, 'opened_at': 0, 'cooldown': 0})
+        if success:
+            if breaker['state'] != 'closed':
+                context.log(f"Circuit for {provider_id} closed after a successful probe")
+            breaker.update(state='closed', failures=0)
+            return
+        breaker['failures'] += 1
+        rate_limited = error is not None and is_rate_limit_error(error)
+        if breaker['state'] == 'half_open' or rate_limited or breaker['failures'] >= get_int_env('BREAKER_FAILURE_THRESHOLD', 3):
+            cooldown = (get_retry_after(error) if rate_limited else None) or get_float_env('BREAKER_COOLDOWN', 300)
+            if rate_limited:
+                reason = "rate limited"
+            elif breaker['state'] == 'half_open':
+                reason = "probe failed"
+            else:
+                reason = f"{breaker['failures']} consecutive failures"
+            breaker.update(state='open', opened_at=time.time(), cooldown=cooldown)
+            context.log(f"Circuit for {provider_id} opened for {cooldown:.0f} seconds ({reason})")
+
+def release_circuit_probe(provider):
+    # For calls that neither succeeded nor failed: a half-open breaker goes back to open with its
+    # cooldown already elapsed, so the next call probes again.
+    with CIRCUIT_BREAKERS_LOCK:
+        breaker = CIRCUIT_BREAKERS.get(get_provider_id(provider))
+        if breaker and breaker['state'] == 'half_open':
+            breaker['state'] = 'open'
+
+def call_provider(provider, prompt, original_title, original_summary, full_explanation, feed_name, context, fields=REFINED_KEY_ORDER):
+    if not acquire_circuit(provider, context):
+        context.log(f"Circuit for {provider['name']} is open. Skipping.")
+        return None
+    start_time = time.time()
+    result, error = request_refined_article(provider, prompt, original_title, original_summary, full_explanation, feed_name, context, fields)
+    # Routing ranks providers by time to a valid answer, so a rejected answer is recorded as a failure there.
+    record_provider_outcome(provider, result is not None, time.time() - start_time, context)
+    if result is None and error is None:
+        # The call went through but the answer was rejected, often because the source content was too
+        # short, so the circuit breaker is left as it was.
+        release_circuit_probe(provider)
+        return None
+    record_circuit_result(provider, result is not None, error, context)
+    return result
+
+def request_refined_article(provider, prompt, original_title, original_summary, full_explanation, feed_name, context, fields=REFINED_KEY_ORDER):
+    # Returns (article, error). error is set only when the API call itself failed (timeout, HTTP error, 429),
+    # so answers rejected during parsing or validation do not count against the provider's circuit breaker.
+    if 'full_explanation' not in fields and provider.get('fast_model'):
+        provider = dict(provider, model=provider['fast_model'])
+    name = provider['name']
+    context.log(f"Calling {name} for article: {original_title}")
+    start_time = time.time()
+    # A short explanation is no reason to abort the stream when the field repair call can extend it.
+    field_repair = is_field_repair_enabled()
+    stream_guard = None
+    if is_streaming_enabled(provider):
+        stream_guard = new_stream_guard(0 if field_repair else 500)
+    try:
+        ai_response = PROVIDER_BACKENDS[provider['type']](provider, prompt, stream_guard, get_fields_schema(fields))
+    except StreamAborted as e:
         elapsed_time = time.time() - start_time
-        context.log(f"Aval AI response time: {elapsed_time:.2f} seconds")
-        result = response.json()
-        ai_response = result.get('choices', [{}])[0].get('message', {}).get('content', '{}').strip()
-        context.log(f"Aval AI raw response (first 500 chars): {ai_response[:500]}")
-        try:
-            refined_data = json.loads(ai_response)
-            tags = refined_data.get('tags', ["خبر", "جهان", feed_name.lower().replace(" ", "_")])
-            if not isinstance(tags, list) or len(tags) < 3 or len(tags) > 5:
-                tags = ["خبر", "جهان", feed_name.lower().replace(" ", "_")]
-            full_explanation = refined_data.get('full_explanation', '')
-            if not full_explanation or len(full_explanation) < 500:
-                context.log(f"Aval AI full_explanation invalid or too short ({len(full_explanation)} chars). Skipping article.")
-                return None
-            context.log("Aval AI succeeded")
-            return {
-                "title": refined_data.get('title', original_title)[:255],
-                "summary": refined_data.get('summary', original_summary)[:100],
-                "full_explanation": full_explanation,
-                "category": refined_data.get('category', "جهان"),
-                "tags": tags
-            }
-        except json.JSONDecodeError:
-            refined_data = partial_parse_json(ai_response, context)
-            if refined_data:
-                tags = refined_data.get('tags', ["خبر", "جهان", feed_name.lower().replace(" ", "_")])
-                if not tags or len(tags) < 3 or len(tags) > 5:
-                    tags = ["خبر", "جهان", feed_name.lower().replace(" ", "_")]
-                full_explanation = refined_data.get('full_explanation', '')
-                if not full_explanation or len(full_explanation) < 500:
-                    context.log(f"Aval AI full_explanation invalid or too short ({len(full_explanation)} chars). Skipping article.")
-                    return None
-                context.log("Aval AI succeeded with partial JSON parsing")
-                return {
-                    "title": refined_data.get('title', original_title)[:255],
-                    "summary": refined_data.get('summary', original_summary)[:100],
-                    "full_explanation": full_explanation,
-                    "category": refined_data.get('category', "جهان"),
-                    "tags": tags
-                }
-            context.log("Aval AI JSON parsing failed. Skipping article.")
+        context.log(f"{name} stream aborted for '{original_title}': {str(e)}. Response time: {elapsed_time:.2f} seconds. Trying next API.")
+        return None, None
+    except Exception as e:
+        elapsed_time = time.time() - start_time
+        context.log(f"{name} API call failed for '{original_title}': {str(e)}. Response time: {elapsed_time:.2f} seconds. Trying next API.")
+        return None, e
+    elapsed_time = time.time() - start_time
+    context.log(f"{name} {'streamed ' if stream_guard else ''}response time: {elapsed_time:.2f} seconds")
+    context.log(f"{name} raw response (first 500 chars): {(ai_response or '')[:500]}")
+    try:
+        refined_data, partial = parse_ai_response(ai_response, context)
+        if not refined_data:
+            context.log(f"{name} JSON parsing failed. Trying next API.")
+            return None, None
+        invalid_fields = find_invalid_fields(refined_data, fields)
+        if invalid_fields and field_repair:
+            refined_data = repair_refined_fields(provider, refined_data, invalid_fields, original_title, full_explanation, context)
+        result, error = validate_refined_data(refined_data, original_title, original_summary, feed_name, fields)
+        if error:
+            context.log(f"{name} {error}. Trying next API.")
+            return None, None
+        context.log(f"{name} succeeded" + (" with partial JSON parsing" if partial else ""))
+        return result, None
+    except Exception as e:
+        context.log(f"{name} answer for '{original_title}' could not be processed: {str(e)}. Trying next API.")
+        return None, None
+
+def run_attempts_sequentially(attempts, context):
+    for _, attempt in attempts:
+        refined_data = attempt()
+        if refined_data:
+            return refined_data
+    return None
+
+def run_attempts_hedged(attempts, hedge_delay, context):
+    # Starts the next provider whenever the running ones have produced nothing valid within hedge_delay
+    # seconds, or immediately when every running attempt has failed. The first valid answer wins; queued attempts are cancelled and
+    # in-flight HTTP calls are left to finish in the background with their results ignored.
+    executor = ThreadPoolExecutor(max_workers=len(attempts))
+    pending = set()
+    next_index = 0
+    try:
+        while pending or next_index < len(attempts):
+            if next_index < len(attempts) and not pending:
+                name, attempt = attempts[next_index]
+                context.log(f"Hedged AI mode: starting {name}")
+                pending.add(executor.submit(attempt))
+                next_index += 1
+            done, pending = wait(pending, timeout=hedge_delay if next_index < len(attempts) else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    refined_data = future.result()
+                except Exception as e:
+                    context.log(f"Hedged AI attempt raised an unexpected error: {str(e)}")
+                    refined_data = None
+                if refined_data:
+                    if pending:
+                        context.log(f"Hedged AI mode: valid answer received, cancelling {len(pending)} slower attempts")
+                    return refined_data
+            if not done and next_index < len(attempts):
+                name, attempt = attempts[next_index]
+                context.log(f"Hedged AI mode: no valid answer after {hedge_delay:.1f} seconds, starting {name} in parallel")
+                pending.add(executor.submit(attempt))
+                next_index += 1
+        return None
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def normalize_for_cache(text):
+    return re.sub(r'\s+', ' ', str(text or '')).strip().lower()
+
+def get_llm_cache_key(original_title, original_summary, full_explanation, fields=REFINED_KEY_ORDER):
+    material = '\x1f'.join([
+        PROMPT_VERSION if fields == REFINED_KEY_ORDER else f"{PROMPT_VERSION}:{','.join(fields)}",
+        normalize_for_cache(original_title),
+        normalize_for_cache(original_summary),
+        normalize_for_cache(full_explanation)
+    ])
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+def load_cached_refinement(cache_key, context):
+    try:
+        rows = state_db_execute("SELECT result, created_at FROM llm_cache WHERE cache_key = ?", (cache_key,))
+        if not rows or time.time() - rows[0][1] > get_int_env('LLM_CACHE_TTL', 7 * 24 * 3600):
+            record_cache_event('llm_cache', False)
             return None
+        state_db_execute("UPDATE llm_cache SET last_access = ? WHERE cache_key = ?", (time.time(), cache_key))
+        record_cache_event('llm_cache', True)
+        return json.loads(rows[0][0])
+    except Exception as e:
+        context.log(f"LLM cache lookup failed: {str(e)}")
+        return None
+
+def save_cached_refinement(cache_key, refined_data, context):
+    try:
+        now = time.time()
+        state_db_execute(
+            "INSERT OR REPLACE INTO llm_cache (cache_key, result, created_at, last_access) VALUES (?, ?, ?, ?)",
+            (cache_key, json.dumps(refined_data, ensure_ascii=False), now, now)
+        )
+        state_db_execute("DELETE FROM llm_cache WHERE created_at < ?", (now - get_int_env('LLM_CACHE_TTL', 7 * 24 * 3600),))
+        state_db_execute(
+            "DELETE FROM llm_cache WHERE cache_key NOT IN (SELECT cache_key FROM llm_cache ORDER BY last_access DESC LIMIT ?)",
+            (get_int_env('LLM_CACHE_MAX_ENTRIES', 2000),)
+        )
+    except Exception as e:
+        context.log(f"LLM cache store failed: {str(e)}")
+
+# The article classifier is kept at module level, so a warm container retrains it at most every CLASSIFIER_TTL seconds.
+# process_rss_feeds registers the databases handle so the offline fallback can train on first use.
+ARTICLE_CLASSIFIER = {'model': None, 'trained_at': 0, 'failed_at': 0, 'databases': None}
+ARTICLE_CLASSIFIER_LOCK = threading.Lock()
+
+def is_offline_fallback_enabled():
+    return os.environ.get('OFFLINE_FALLBACK', '1') == '1'
+
+def fetch_training_articles(databases, context):
+    documents = []
+    limit = get_int_env('CLASSIFIER_TRAINING_LIMIT', 1000)
+    while len(documents) < limit:
+        page_size = min(100, limit - len(documents))
+        response = databases.list_documents(
+            database_id=os.environ['APPWRITE_DATABASE_ID'],
+            collection_id=os.environ['APPWRITE_NEWS_ARTICLES_COLLECTION_ID'],
+            queries=[
+                Query.select(['title', 'summary', 'full_explanation', 'category', 'tags']),
+                Query.order_desc('$createdAt'),
+                Query.limit(page_size),
+                Query.offset(len(documents))
+            ]
+        )
+        page = response['documents']
+        documents.extend(page)
+        if len(page) < page_size:
+            break
+    return documents
+
+def add_label_example(label_model, label, token_weights):
+    stats = label_model.setdefault(label, {'documents': 0, 'total': 0.0, 'tokens': {}})
+    stats['documents'] += 1
+    for token, weight in token_weights.items():
+        stats['tokens'][token] = stats['tokens'].get(token, 0.0) + weight
+        stats['total'] += weight
+
+def count_tokens(text):
+    token_counts = {}
+    for token in tokenize_for_ranking(text):
+        token_counts[token] = token_counts.get(token, 0) + 1
+    return token_counts
+
+def get_tfidf_weights(token_counts, idf):
+    # Log-scaled term frequency times idf, L2-normalised; tokens never seen in training are dropped.
+    weights = {token: math.log(1 + count) * idf[token] for token, count in token_counts.items() if token in idf}
+    norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1.0
+    return {token: weight / norm for token, weight in weights.items()}
+
+def build_label_table(label_model, vocabulary_size, alpha):
+    # Per-label smoothed log-probabilities, so scoring a text is a weighted sum of table lookups.
+    tables = {}
+    for label, stats in label_model.items():
+        denominator = stats['total'] + alpha * vocabulary_size
+        tables[label] = {
+            'unseen': math.log(alpha / denominator),
+            'weights': {token: math.log((weight + alpha) / denominator) for token, weight in stats['tokens'].items()}
+        }
+    return tables
+
+def train_article_classifier(documents):
+    # TF-IDF weighted multinomial naive Bayes without class priors, which makes each label's score a
+    # linear function of the text's TF-IDF vector. One table covers the categories and one the tags,
+    # each tag seen at least CLASSIFIER_MIN_TAG_COUNT times being a label of its own. A background table
+    # over all documents is what a tag has to beat to be assigned.
+    tokenized = []
+    document_frequency = {}
+    for document in documents:
+        token_counts = count_tokens(' '.join(str(document.get(key) or '') for key in ('title', 'summary', 'full_explanation')))
+        if not token_counts:
+            continue
+        tokenized.append((document, token_counts))
+        for token in token_counts:
+            document_frequency[token] = document_frequency.get(token, 0) + 1
+    idf = {token: math.log((len(tokenized) + 1) / (count + 1)) + 1 for token, count in document_frequency.items()}
+
+    categories = {}
+    tags = {}
+    background = {}
+    for document, token_counts in tokenized:
+        token_weights = get_tfidf_weights(token_counts, idf)
+        add_label_example(background, 'all', token_weights)
+        if document.get('category') in VALID_CATEGORIES:
+            add_label_example(categories, document['category'], token_weights)
+        for tag in set(document.get('tags') or []):
+            add_label_example(tags, tag, token_weights)
+    min_tag_count = get_int_env('CLASSIFIER_MIN_TAG_COUNT', 2)
+    frequent_tags = sorted(tags, key=lambda tag: tags[tag]['documents'], reverse=True)[:get_int_env('CLASSIFIER_MAX_TAGS', 200)]
+    alpha = get_float_env('CLASSIFIER_ALPHA', 0.1)
+    return {
+        'idf': idf,
+        'categories': build_label_table(categories, len(idf), alpha),
+        'tags': build_label_table({tag: tags[tag] for tag in frequent_tags if tags[tag]['documents'] >= min_tag_count}, len(idf), alpha),
+        'background': build_label_table(background, len(idf), alpha).get('all'),
+        'documents': sum(stats['documents'] for stats in categories.values())
+    }
+
+def score_label(table, token_weights):
+    label_weights = table['weights']
+    unseen = table['unseen']
+    return sum(weight * label_weights.get(token, unseen) for token, weight in token_weights.items())
+
+def rank_labels(tables, token_weights, min_score=None):
+    # Best label first; with min_score, labels scoring at or below it are left out.
+    scored = [(score_label(table, token_weights), label) for label, table in tables.items()]
+    return [label for score, label in sorted(scored, reverse=True) if min_score is None or score > min_score]
+
+def classify_articles(model, texts):
+    # Batch prediction API: returns one (category, tags) pair per text, with category None and tags
+    # empty when the model has nothing to go on. The IDF and label tables are shared across the batch.
+    predictions = []
+    for text in texts:
+        token_weights = get_tfidf_weights(count_tokens(text), model['idf']) if model else {}
+        if not token_weights:
+            predictions.append((None, []))
+            continue
+        categories = rank_labels(model['categories'], token_weights)
+        # A tag is kept only when the text is likelier under it than under the corpus as a whole, plus
+        # CLASSIFIER_TAG_MARGIN, so unrelated tags are not used as padding.
+        min_tag_score = score_label(model['background'], token_weights) + get_float_env('CLASSIFIER_TAG_MARGIN', 0.0) \
+            if model.get('background') else None
+        predictions.append((categories[0] if categories else None, rank_labels(model['tags'], token_weights, min_tag_score)[:4]))
+    return predictions
+
+def is_local_classifier_active():
+    # LOCAL_CLASSIFIER=1 moves category and tags out of the LLM prompt once the model has seen
+    # CLASSIFIER_MIN_DOCUMENTS categorised articles; until then the LLM keeps classifying.
+    model = ARTICLE_CLASSIFIER['model']
+    return os.environ.get('LOCAL_CLASSIFIER', '0') == '1' and bool(model) \
+        and model['documents'] >= get_int_env('CLASSIFIER_MIN_DOCUMENTS', 200)
+
+def get_llm_fields(fields):
+    if is_local_classifier_active():
+        return [field for field in fields if field not in CLASSIFIED_FIELDS]
+    return fields
+
+def apply_local_classification(items, results, context):
+    # Fills category and tags of the refined results in place, with one batch prediction for all of them.
+    indexes = [index for index, result in enumerate(results) if result]
+    if not indexes:
+        return
+    start_time = time.time()
+    texts = [
+        f"{results[index]['title']} {results[index]['summary']} {results[index].get('full_explanation') or ''} {items[index]['full_explanation']}"
+        for index in indexes
+    ]
+    for index, (category, tags) in zip(indexes, classify_articles(ARTICLE_CLASSIFIER['model'], texts)):
+        feed_name = items[index]['feed_name']
+        results[index]['category'] = category or "جهان"
+        results[index]['tags'] = tags if len(tags) >= 3 else ["خبر", "جهان", feed_name.lower().replace(" ", "_")]
+    context.log(f"Classified {len(indexes)} articles locally in {(time.time() - start_time) * 1000:.1f} ms")
+
+def ensure_article_classifier(databases, context):
+    with ARTICLE_CLASSIFIER_LOCK:
+        if time.time() - ARTICLE_CLASSIFIER['trained_at'] < get_int_env('CLASSIFIER_TTL', 6 * 3600) \
+                or time.time() - ARTICLE_CLASSIFIER['failed_at'] < 300:
+            return ARTICLE_CLASSIFIER['model']
+        start_time = time.time()
+        try:
+            documents = fetch_training_articles(databases, context)
+            model = train_article_classifier(documents)
+            ARTICLE_CLASSIFIER['model'] = model
+            context.log(
+                f"Trained article classifier on {model['documents']} articles ({len(model['categories'])} categories, "
+                f"{len(model['tags'])} tags) in {(time.time() - start_time) * 1000:.0f} ms"
+            )
+        except Exception as e:
+            context.log(f"Failed to train article classifier: {str(e)}. Retrying in 5 minutes.")
+            ARTICLE_CLASSIFIER['failed_at'] = time.time()
+            return ARTICLE_CLASSIFIER['model']
+        ARTICLE_CLASSIFIER['trained_at'] = time.time()
+        return ARTICLE_CLASSIFIER['model']
+
+def is_mostly_arabic_script(text):
+    letters = sum(1 for char in text if char.isalpha())
+    return bool(letters) and len(ARABIC_SCRIPT_PATTERN.findall(text)) >= letters * 0.5
+
+def refine_article_offline(original_title, original_summary, full_explanation, feed_name, context):
+    # Degraded result for when no provider produced a valid answer: the explanation is extracted from the
+    # scraped content and category and tags come from the local classifier. Nothing is translated, so
+    # only sources already written in Persian are eligible.
+    if not is_offline_fallback_enabled():
+        context.log(f"Offline fallback disabled. Skipping article '{original_title}'.")
+        return None
+    compressed = compress_content(original_title, original_summary, full_explanation, get_int_env('OFFLINE_EXPLANATION_TOKEN_BUDGET', 400))
+    explanation = truncate_text(compressed, 2000)
+    if not is_mostly_arabic_script(f"{original_title} {explanation}"):
+        context.log(f"Source is not in Persian, so there is no offline article. Skipping article '{original_title}'.")
+        return None
+    if len(explanation) < 500:
+        context.log(f"Scraped content too short for an offline article ({len(explanation)} chars). Skipping article '{original_title}'.")
+        return None
+    if ARTICLE_CLASSIFIER['databases'] is not None:
+        ensure_article_classifier(ARTICLE_CLASSIFIER['databases'], context)
+    start_time = time.time()
+    category, tags = classify_articles(ARTICLE_CLASSIFIER['model'], [f"{original_title} {original_summary} {explanation}"])[0]
+    if len(tags) < 3:
+        tags = ["خبر", "جهان", feed_name.lower().replace(" ", "_")]
+    context.log(f"Built offline article for '{original_title}' in {(time.time() - start_time) * 1000:.1f} ms (category: {category or 'جهان'})")
+    return {
+        "title": original_title[:255],
+        "summary": truncate_text(original_summary or explanation, 100),
+        "full_explanation": explanation,
+        "category": category or "جهان",
+        "tags": tags
+    }
+
+def refine_article_with_ai(original_title, original_summary, full_explanation, feed_name, context, fields=REFINED_KEY_ORDER):
+    # fields narrows the request to part of the article; the two-phase mode asks for HEADLINE_FIELDS, then EXPLANATION_FIELDS.
+    llm_fields = get_llm_fields(fields)
+    if llm_fields != fields:
+        refined_data = refine_article_with_ai(original_title, original_summary, full_explanation, feed_name, context, llm_fields)
+        item = {'full_explanation': full_explanation, 'feed_name': feed_name}
+        apply_local_classification([item], [refined_data], context)
+        return refined_data
+
+    cache_key = get_llm_cache_key(original_title, original_summary, full_explanation, fields)
+    cached = load_cached_refinement(cache_key, context)
+    if cached:
+        context.log(f"Using cached AI result for '{original_title}'")
+        return cached
+
+    if fields == REFINED_KEY_ORDER:
+        prompt = build_refine_prompt(original_title, original_summary, full_explanation, feed_name)
+    else:
+        prompt = build_fields_refine_prompt(original_title, original_summary, full_explanation, feed_name, fields)
+    providers = load_provider_chain(context)
+    if not providers:
+        context.log("No AI providers configured.")
+        return refine_article_offline(original_title, original_summary, full_explanation, feed_name, context)
+    providers = order_providers_by_expected_latency(providers, context)
+
+    attempts = [
+        (provider['name'], lambda provider=provider: call_provider(provider, prompt, original_title, original_summary, full_explanation, feed_name, context, fields))
+        for provider in providers
+    ]
+    hedge_delay = get_float_env('LLM_HEDGE_DELAY', 0)
+    if hedge_delay > 0 and len(attempts) > 1:
+        refined_data = run_attempts_hedged(attempts, hedge_delay, context)
+    else:
+        refined_data = run_attempts_sequentially(attempts, context)
+    if not refined_data:
+        context.log(f"All AI providers failed for '{original_title}'.")
+        return refine_article_offline(original_title, original_summary, full_explanation, feed_name, context)
+    save_cached_refinement(cache_key, refined_data, context)
+    return refined_data
+
+def parse_batch_ai_response(ai_response, count):
+    ai_response = re.sub(r'^```(?:json)?\s*|\s*```$', '', (ai_response or '').strip()).strip()
+    try:
+        data = json.loads(ai_response)
+    except json.JSONDecodeError:
+        data = repair_json(ai_response)
+    if isinstance(data, dict):
+        data = data.get('articles') or data.get('results') or []
+    if not isinstance(data, list):
+        return [None] * count
+    results = [None] * count
+    for position, entry in enumerate(data):
+        if not isinstance(entry, dict):
+            continue
+        try:
+            index = int(entry.get('id', position + 1)) - 1
+        except (TypeError, ValueError):
+            index = position
+        if 0 <= index < count and results[index] is None:
+            results[index] = entry
+    return results
+
+def request_batch_refined_articles(provider, items, context, fields=REFINED_KEY_ORDER):
+    name = provider['name']
+    # A batch answer is several articles long, so the per-request timeout scales with the batch size.
+    batch_provider = dict(provider)
+    if provider.get('batch_timeout') or provider.get('timeout'):
+        batch_provider['timeout'] = provider.get('batch_timeout') or provider['timeout'] * len(items)
+    context.log(f"Calling {name} for a batch of {len(items)} articles")
+    start_time = time.time()
+    try:
+        ai_response = PROVIDER_BACKENDS[provider['type']](batch_provider, build_batch_refine_prompt(items, fields), None, get_batch_fields_schema(fields))
+        elapsed_time = time.time() - start_time
+        context.log(f"{name} batch response time: {elapsed_time:.2f} seconds")
+        context.log(f"{name} batch raw response (first 500 chars): {(ai_response or '')[:500]}")
     except Exception as e:
         elapsed_time = time.time() - start_time
-        context.log(f"Aval AI API call failed for '{original_title}': {str(e)}. Response time: {elapsed_time:.2f} seconds. Skipping article.")
+        context.log(f"{name} batch API call failed: {str(e)}. Response time: {elapsed_time:.2f} seconds.")
+        return [None] * len(items), e
+
+    try:
+        parsed = parse_batch_ai_response(ai_response, len(items))
+    except Exception as e:
+        context.log(f"{name} batch answer could not be parsed: {str(e)}")
+        parsed = [None] * len(items)
+    results = []
+    for item, refined_data in zip(items, parsed):
+        if not refined_data:
+            context.log(f"{name} batch answer missing or unparsable for '{item['original_title']}'")
+            results.append(None)
+            continue
+        # A bad item only sends that article to the single-article retry, never the whole batch down.
+        try:
+            result, error = validate_refined_data(refined_data, item['original_title'], item['original_summary'], item['feed_name'], fields)
+        except Exception as e:
+            result, error = None, f"invalid answer ({str(e)})"
+        if error:
+            context.log(f"{name} batch answer for '{item['original_title']}': {error}")
+        results.append(result)
+    return results, None
+
+def refine_articles_with_ai(items, context, fields=REFINED_KEY_ORDER):
+    # Batch counterpart of refine_article_with_ai. items carry original_title, original_summary,
+    # full_explanation and feed_name; the result list is aligned with items and holds None for failures.
+    llm_fields = get_llm_fields(fields)
+    if llm_fields != fields:
+        results = refine_articles_with_ai(items, context, llm_fields)
+        apply_local_classification(items, results, context)
+        return results
+
+    if len(items) == 1:
+        item = items[0]
+        return [refine_article_with_ai(item['original_title'], item['original_summary'], item['full_explanation'], item['feed_name'], context, fields)]
+
+    results = [None] * len(items)
+    cache_keys = [get_llm_cache_key(item['original_title'], item['original_summary'], item['full_explanation'], fields) for item in items]
+    for index, cache_key in enumerate(cache_keys):
+        results[index] = load_cached_refinement(cache_key, context)
+        if results[index]:
+            context.log(f"Using cached AI result for '{items[index]['original_title']}'")
+    pending = [index for index in range(len(items)) if results[index] is None]
+    if len(pending) < 2:
+        for index in pending:
+            item = items[index]
+            results[index] = refine_article_with_ai(item['original_title'], item['original_summary'], item['full_explanation'], item['feed_name'], context, fields)
+        return results
+
+    batch_items = [items[index] for index in pending]
+    batch_results = [None] * len(batch_items)
+    providers = [provider for provider in load_provider_chain(context) if provider.get('batch', True)]
+    for provider in order_providers_by_expected_latency(providers, context, batch=True):
+        if not acquire_circuit(provider, context):
+            context.log(f"Circuit for {provider['name']} is open. Skipping.")
+            continue
+        start_time = time.time()
+        provider_results, error = request_batch_refined_articles(provider, batch_items, context, fields)
+        succeeded = any(provider_results)
+        record_provider_outcome(provider, succeeded, time.time() - start_time, context, batch=True)
+        if succeeded or error is not None:
+            record_circuit_result(provider, succeeded, error, context)
+        else:
+            release_circuit_probe(provider)
+        if succeeded:
+            batch_results = provider_results
+            context.log(f"{provider['name']} batch succeeded for {sum(1 for result in batch_results if result)} of {len(batch_items)} articles")
+            break
+
+    for index, refined_data in zip(pending, batch_results):
+        item = items[index]
+        if refined_data:
+            save_cached_refinement(cache_keys[index], refined_data, context)
+            results[index] = refined_data
+        else:
+            context.log(f"Retrying '{item['original_title']}' on its own after the batch call")
+            results[index] = refine_article_with_ai(item['original_title'], item['original_summary'], item['full_explanation'], item['feed_name'], context, fields)
+    return results
+
+def mark_task_done(databases, task_id, task_name, context, reason=None):
+    suffix = f" due to {reason}" if reason else ""
+    try:
+        context.log(f"Updating task {task_name} (ID: {task_id}) isdone to true{suffix}")
+        databases.update_document(
+            database_id=os.environ['APPWRITE_DATABASE_ID'],
+            collection_id=os.environ['APPWRITE_SCRAPE_TASKS_COLLECTION_ID'],
+            document_id=task_id,
+            data={"isdone": True}
+        )
+        context.log(f"Updated task {task_name} isdone to true")
+        return True
+    except Exception as e:
+        context.log(f"Failed to update task '{task_name}' isdone: {str(e)}")
+        return False
+
+def prepare_entry(entry, feed_name, context):
+    article_url = entry.get('link', '')
+    if not article_url:
+        context.log(f"No valid URL found for article in {feed_name}")
+        return None
+    embedded_text = get_embedded_full_text(entry)
+    if len(embedded_text) >= get_int_env('FEED_FULL_TEXT_MIN_CHARS', 1000):
+        context.log(f"Using full text embedded in feed for {article_url} ({len(embedded_text)} chars). Skipping scraping.")
+        full_explanation = embedded_text
+    else:
+        with stage_slot('scrape'):
+            full_explanation = scrape_article_text(article_url, context)
+    if full_explanation == "Scraping failed":
+        context.log(f"Scraping failed for {article_url}. Using RSS summary as fallback.")
+        full_explanation = html.unescape(re.sub(r'<[^>]+>', '', entry.get('description', entry.get('summary', 'No content available'))))
+    original_title = entry.get('title', 'Unknown Title')
+    original_summary = truncate_text(html.unescape(re.sub(r'<[^>]+>', '', entry.get('description', entry.get('summary', '')))), 100)
+    token_budget = get_int_env('PROMPT_CONTENT_TOKEN_BUDGET', 1500)
+    compressed = compress_content(original_title, original_summary, full_explanation, token_budget)
+    if len(compressed) < len(full_explanation):
+        context.log(f"Compressed scraped content for {article_url} from {len(full_explanation)} to {len(compressed)} chars")
+    return {
+        "original_title": original_title,
+        "original_summary": original_summary,
+        "full_explanation": compressed,
+        "feed_name": feed_name,
+        "article_url": article_url
+    }
+
+def assemble_article(item, refined_data, task_id):
+    return {
+        "title": refined_data["title"],
+        "summary": refined_data["summary"],
+        "full_explanation": refined_data["full_explanation"],
+        "citations": [shorten_url(item['article_url'])],
+        "category": refined_data["category"],
+        "tags": refined_data["tags"],
+        "source": item['feed_name'],
+        "task_id": task_id
+    }
+
+def is_two_phase_enabled():
+    return os.environ.get('TWO_PHASE_PUBLISH', '0') == '1'
+
+def build_article_from_item(item, task_id, context):
+    feed_name = item['feed_name']
+    two_phase = is_two_phase_enabled()
+    with stage_slot('ai'):
+        refined_data = refine_article_with_ai(
+            item['original_title'], item['original_summary'], item['full_explanation'], feed_name, context,
+            HEADLINE_FIELDS if two_phase else REFINED_KEY_ORDER
+        )
+    if not refined_data:
+        context.log(f"AI processing failed for {feed_name}. Skipping article.")
         return None
+    context.log(f"Found article for {feed_name}: {refined_data['title']}")
+    article = assemble_article(item, refined_data, task_id)
+    if two_phase:
+        # Published with the summary standing in for full_explanation; complete_article_explanation patches it later.
+        article['full_explanation'] = article['summary']
+        article['pending_explanation'] = item
+    return article
+
+def complete_article_explanation(article, context, databases, start_time):
+    # Second phase of TWO_PHASE_PUBLISH: generate full_explanation for an already published article,
+    # then patch the stored document and the Telegram post. On failure the provisional text stays.
+    item = article.pop('pending_explanation')
+    title = article['title']
+    if time.time() - start_time > 550:
+        context.log(f"Approaching 600-second timeout. Leaving provisional explanation for '{title}'")
+        return
+    with stage_slot('ai'):
+        refined_data = refine_article_with_ai(
+            item['original_title'], item['original_summary'], item['full_explanation'], item['feed_name'], context, EXPLANATION_FIELDS
+        )
+    if not refined_data:
+        context.log(f"AI processing failed for the explanation of '{title}'. Keeping provisional explanation.")
+        return
+    full_explanation = refined_data['full_explanation']
+    if len(full_explanation) > 2000:
+        full_explanation = truncate_text(full_explanation, 2000)
+    if article.get('document_id'):
+        try:
+            with stage_slot('store'):
+                databases.update_document(
+                    database_id=os.environ['APPWRITE_DATABASE_ID'],
+                    collection_id=os.environ['APPWRITE_NEWS_ARTICLES_COLLECTION_ID'],
+                    document_id=article['document_id'],
+                    data={'full_explanation': full_explanation}
+                )
+            context.log(f"Patched full_explanation for '{title}' ({len(full_explanation)} chars)")
+        except Exception as e:
+            context.log(f"Failed to patch full_explanation for '{title}': {str(e)}")
+            return
+    article['full_explanation'] = full_explanation
+    if article.get('telegram_message_id'):
+        edit_telegram_message(article, article['telegram_message_id'], context)
 
-def fetch_rss_feed(task, context, start_time, databases):
+def fetch_rss_feed(task, context, start_time, refine=True):
+    # Yields one refined article per unseen entry, newest first. The caller decides how many to draw.
+    # With refine=False it yields the scraped, not yet refined items so the caller can batch the AI step.
     if time.time() - start_time > 550:
         context.log(f"Approaching 600-second timeout. Skipping task: {task['name']}")
-        return None
+        return
 
     rss_url = task["url"]
     feed_name = task["name"]
     task_id = task["$id"]
     context.log(f"Fetching RSS feed for {feed_name}")
     try:
-        feed_data = parse_rss(rss_url)
+        with stage_slot('feed'):
+            feed_data, validators = fetch_feed_if_changed(rss_url, context)
+        if feed_data is None:
+            context.log(f"No changes in RSS feed for {feed_name}. Skipping scraping and AI processing.")
+            return
         if not hasattr(feed_data, 'entries') or not feed_data.entries:
             context.log(f"Invalid or empty RSS feed for {feed_name}: No entries found")
             if feed_data and hasattr(feed_data, 'bozo_exception'):
                 context.log(f"RSS parsing error: {str(feed_data.bozo_exception)}")
-            return None
-        latest_entry = feed_data.entries[0]
-        article_url = latest_entry.get('link', '')
-        if not article_url:
-            context.log(f"No valid URL found for article in {feed_name}")
-            return None
-        full_explanation = scrape_article_text(article_url, context)
-        if full_explanation == "Scraping failed":
-            context.log(f"Scraping failed for {article_url}. Using RSS summary as fallback.")
-            full_explanation = html.unescape(re.sub(r'<[^>]+>', '', latest_entry.get('description', latest_entry.get('summary', 'No content available'))))
-        original_title = latest_entry.get('title', 'Unknown Title')
-        original_summary = truncate_text(html.unescape(re.sub(r'<[^>]+>', '', latest_entry.get('description', latest_entry.get('summary', '')))), 100)
-        refined_data = refine_article_with_ai(original_title, original_summary, full_explanation, feed_name, context)
-        if not refined_data:
-            context.log(f"AI processing failed for {feed_name}. Skipping article.")
-            try:
-                context.log(f"Updating task {feed_name} (ID: {task_id}) isdone to true due to AI processing failure")
-                databases.update_document(
-                    database_id=os.environ['APPWRITE_DATABASE_ID'],
-                    collection_id=os.environ['APPWRITE_SCRAPE_TASKS_COLLECTION_ID'],
-                    document_id=task_id,
-                    data={"isdone": True}
-                )
-                context.log(f"Updated task {feed_name} isdone to true")
-            except Exception as e:
-                context.log(f"Failed to update task '{feed_name}' isdone: {str(e)}")
-            return None
-        context.log(f"Found article for {feed_name}: {refined_data['title']}")
-        return {
-            "title": refined_data["title"],
-            "summary": refined_data["summary"],
-            "full_explanation": refined_data["full_explanation"],
-            "citations": [shorten_url(article_url)],
-            "category": refined_data["category"],
-            "tags": refined_data["tags"],
-            "source": feed_name,
-            "task_id": task_id
-        }
+            return
+        seen_keys, high_water = load_seen_index(rss_url, context)
+        unseen_entries = [
+            entry for entry in sort_entries_newest_first(feed_data.entries)
+            if not is_entry_seen(entry, seen_keys, high_water)
+        ]
     except Exception as e:
         context.log(f"RSS fetch failed for {feed_name}: {str(e)}")
+        return
+
+    if not unseen_entries:
+        context.log(f"No new entries in RSS feed for {feed_name}. Skipping scraping and AI processing.")
+        save_feed_validators(rss_url, validators, context)
+        return
+
+    max_entries = max(1, get_int_env('MAX_ENTRIES_PER_FEED', 5))
+    if high_water is None and not seen_keys:
+        # First poll of this feed, or a cold start with an empty index: everything looks new, so only the
+        # newest entry is processed and the rest of the feed seeds the index instead of being republished.
+        context.log(f"No seen-entry index for {feed_name} yet. Processing only the newest entry and seeding the index from {len(unseen_entries) - 1} others")
+        for entry in unseen_entries[1:]:
+            mark_entry_seen(rss_url, entry, context)
+        advance_high_water(rss_url, feed_data.entries, context)
+        unseen_entries = unseen_entries[:1]
+    pending = unseen_entries[max_entries:]
+    if pending:
+        context.log(f"{len(unseen_entries)} new entries in {feed_name}; processing the newest {max_entries} and leaving {len(pending)} for the next run")
+    context.log(f"Found {min(len(unseen_entries), max_entries)} new entries in RSS feed for {feed_name}")
+
+    for entry in unseen_entries[:max_entries]:
+        if time.time() - start_time > 550:
+            context.log(f"Approaching 600-second timeout. Stopping entries for {feed_name}")
+            return
+        article = None
         try:
-            context.log(f"Updating task {feed_name} (ID: {task_id}) isdone to true due to RSS fetch failure")
-            databases.update_document(
-                database_id=os.environ['APPWRITE_DATABASE_ID'],
-                collection_id=os.environ['APPWRITE_SCRAPE_TASKS_COLLECTION_ID'],
-                document_id=task_id,
-                data={"isdone": True}
-            )
-            context.log(f"Updated task {feed_name} isdone to true")
+            item = prepare_entry(entry, feed_name, context)
+            article = build_article_from_item(item, task_id, context) if item and refine else item
         except Exception as e:
-            context.log(f"Failed to update task '{feed_name}' isdone: {str(e)}")
+            context.log(f"Processing entry failed for {feed_name}: {str(e)}")
+        if article and not refine:
+            # Not refined yet: the caller marks the entry seen once the batch result is known.
+            article['feed_url'] = rss_url
+            article['entry'] = entry
+            pending.append(entry)
+            yield article
+        elif article:
+            mark_entry_seen(rss_url, entry, context)
+            yield article
+        elif not entry.get('link'):
+            # Nothing to retry without a URL.
+            mark_entry_seen(rss_url, entry, context)
+        elif not record_entry_failure(rss_url, entry, context):
+            # Usually every provider failed; the entry stays unseen and holds the high-water mark.
+            pending.append(entry)
+
+    # A quota stop never gets here. Entries left over by MAX_ENTRIES_PER_FEED or kept for a retry hold the
+    # high-water mark below them and keep the validators unsaved, so the next poll fetches the feed again and picks them up.
+    advance_high_water(rss_url, feed_data.entries, context, pending)
+    if not pending:
+        save_feed_validators(rss_url, validators, context)
+
+def format_telegram_message(article):
+    citation = article['citations'][0] if article['citations'] else None
+    title_escaped = html.escape(article['title'])
+    summary_escaped = html.escape(article['summary'])
+    full_explanation_escaped = html.escape(article['full_explanation'])
+    tags_escaped = html.escape(', '.join(article['tags']))
+
+    message = (
+        f"<b>عنوان خبر:</b> {title_escaped}\n\n"
+        f"<b>برچسب‌ها:</b> {tags_escaped}\n\n"
+        f"<b>خلاصه خبر:</b> {summary_escaped}\n\n"
+        f"<b>جزئیات کامل:</b> {full_explanation_escaped}\n\n"
+    )
+    if citation:
+        message += f"<a href='{citation}'>بیشتر بخوانید</a>"
+
+    if len(message) > 4096:
+        fixed_parts = (
+            f"<b>عنوان خبر:</b> {title_escaped}\n\n"
+            f"<b>برچسب‌ها:</b> {tags_escaped}\n\n"
+            f"<b>خلاصه خبر:</b> {summary_escaped}\n\n"
+            f"<b>جزئیات کامل:</b> "
+            + (f"<a href='{citation}'>بیشتر بخوانید</a>" if citation else "")
+        )
+        remaining_chars = 4096 - len(fixed_parts) - 50
+        full_explanation_escaped = truncate_text(full_explanation_escaped, remaining_chars)
+        message = (
+            f"<b>عنوان خبر:</b> {title_escaped}\n\n"
+            f"<b>برچسب‌ها:</b> {tags_escaped}\n\n"
+            f"<b>خلاصه خبر:</b> {summary_escaped}\n\n"
+            f"<b>جزئیات کامل:</b> {full_explanation_escaped}\n\n"
+        )
+        if citation:
+            message += f"<a href='{citation}'>بیشتر بخوانید</a>"
+    return message
+
+def send_telegram_message(article, context):
+    # Returns the Telegram message_id, so a two-phase article can be edited once its explanation is ready.
+    title = article['title']
+    telegram_token = os.environ.get('TELEGRAM_TOKEN')
+    telegram_chat_id = os.environ.get('TELEGRAM_CHAT_ID')
+    if not telegram_token or not telegram_chat_id:
+        context.log("TELEGRAM_TOKEN or TELEGRAM_CHAT_ID not found. Skipping Telegram posting.")
         return None
 
+    url = f"https://api.telegram.org/bot{telegram_token}/sendMessage"
+    payload = {
+        "chat_id": telegram_chat_id,
+        "text": format_telegram_message(article),
+        "parse_mode": "HTML"
+    }
+    try:
+        response = requests.post(url, json=payload, timeout=5)
+        if response.status_code == 200:
+            context.log(f"Sent Telegram message for article: {title}")
+            return response.json().get('result', {}).get('message_id')
+        else:
+            error_response = response.text
+            context.log(f"Failed to send Telegram message for article: {title}. Status code: {response.status_code}. Error: {error_response}")
+    except Exception as e:
+        context.log(f"Exception while sending Telegram message for article: {title}. Error: {str(e)}")
+    return None
+
+def edit_telegram_message(article, message_id, context):
+    title = article['title']
+    url = f"https://api.telegram.org/bot{os.environ.get('TELEGRAM_TOKEN')}/editMessageText"
+    payload = {
+        "chat_id": os.environ.get('TELEGRAM_CHAT_ID'),
+        "message_id": message_id,
+        "text": format_telegram_message(article),
+        "parse_mode": "HTML"
+    }
+    try:
+        response = requests.post(url, json=payload, timeout=5)
+        if response.status_code == 200:
+            context.log(f"Updated Telegram message for article: {title}")
+        else:
+            context.log(f"Failed to update Telegram message for article: {title}. Status code: {response.status_code}. Error: {response.text}")
+    except Exception as e:
+        context.log(f"Exception while updating Telegram message for article: {title}. Error: {str(e)}")
+
+def reserve_article_slot(quota):
+    with quota['lock']:
+        if quota['remaining'] <= 0:
+            return False
+        quota['remaining'] -= 1
+        return True
+
+def release_article_slot(quota):
+    with quota['lock']:
+        quota['remaining'] += 1
+
+def store_article(article, task, context, databases, valid_categories):
+    title = article['title']
+    source = article['source']
+
+    try:
+        context.log(f"Checking for duplicates: {title}")
+        with stage_slot('store'):
+            existing = databases.list_documents(
+                database_id=os.environ['APPWRITE_DATABASE_ID'],
+                collection_id=os.environ['APPWRITE_NEWS_ARTICLES_COLLECTION_ID'],
+                queries=[Query.equal("title", title), Query.equal("date", datetime.utcnow().strftime('%Y-%m-%d'))]
+            )
+        if existing['total'] > 0:
+            context.log(f"Duplicate article found from {source}: {title}. Skipping article.")
+            return False
+    except Exception as e:
+        context.log(f"Failed to check duplicates for '{title}' from {source}: {str(e)}")
+        return False
+
+    required_keys = ['title', 'summary', 'full_explanation', 'citations', 'category', 'tags']
+    if not all(key in article for key in required_keys):
+        context.log(f"Invalid article data from {source}: {json.dumps(article)}")
+        return False
+
+    if article['category'] not in valid_categories:
+        context.log(f"Invalid category for '{title}' from {source}: {article['category']}. Setting to 'جهان'")
+        article['category'] = 'جهان'
+    if len(article['summary']) > 100:
+        article['summary'] = article['summary'][:100]
+        context.log(f"Truncated summary to 100 chars for '{title}' from {source}")
+    if len(article['full_explanation']) > 2000:
+        context.log(f"full_explanation too long ({len(article['full_explanation'])} chars) for '{title}' from {source}. Truncating gracefully.")
+        article['full_explanation'] = truncate_text(article['full_explanation'], 2000)
+
+    doc = {
+        'title': article['title'],
+        'summary': article['summary'],
+        'full_explanation': article['full_explanation'],
+        'citations': article['citations'],
+        'date': datetime.utcnow().strftime('%Y-%m-%d'),
+        'source': source,
+        'tags': article['tags'],
+        'category': article['category']
+    }
+
+    try:
+        context.log(f"Storing article: {title}")
+        with stage_slot('store'):
+            created = databases.create_document(
+                database_id=os.environ['APPWRITE_DATABASE_ID'],
+                collection_id=os.environ['APPWRITE_NEWS_ARTICLES_COLLECTION_ID'],
+                document_id='unique()',
+                data=doc
+            )
+        article['document_id'] = created.get('$id') if isinstance(created, dict) else None
+        context.log(f"Stored article: {title} from {source}")
+        article['telegram_message_id'] = send_telegram_message(article, context)
+    except Exception as e:
+        context.log(f"Failed to store article '{title}' from {source}: {str(e)}")
+        return False
+
+    logged = {key: value for key, value in article.items() if key != 'pending_explanation'}
+    context.log(f"Processed article from {source}: {json.dumps(logged, ensure_ascii=False)}")
+    return True
+
+def process_task(task, context, databases, start_time, valid_categories, quota):
+    articles = []
+    if time.time() - start_time > 550:
+        context.log(f"Approaching 600-second timeout. Skipping task: {task['name']}")
+        return articles
+
+    elapsed_time = time.time() - start_time
+    context.log(f"Processing task: {task['name']} (Elapsed time: {elapsed_time:.2f} seconds)")
+
+    feed = fetch_rss_feed(task, context, start_time)
+    started = False
+    # Two-phase articles are published as soon as their headline is ready; their explanations are generated
+    # here in the background while the next entries are processed, and awaited before the task is marked done.
+    explanation_executor = ThreadPoolExecutor(max_workers=max(1, get_int_env('EXPLANATION_WORKERS', 2)))
+    explanation_futures = []
+    try:
+        while True:
+            if not reserve_article_slot(quota):
+                context.log(f"Per-run article quota reached. Stopping task {task['name']}")
+                break
+            started = True
+            article = next(feed, None)
+            if article is None:
+                release_article_slot(quota)
+                break
+            if store_article(article, task, context, databases, valid_categories):
+                articles.append(article)
+                if 'pending_explanation' in article:
+                    explanation_futures.append(
+                        explanation_executor.submit(complete_article_explanation, article, context, databases, start_time)
+                    )
+    finally:
+        feed.close()
+        for future in explanation_futures:
+            try:
+                future.result()
+            except Exception as e:
+                context.log(f"Explanation phase raised an unexpected error: {str(e)}")
+        explanation_executor.shutdown()
+
+    if not started:
+        return articles
+    if not articles:
+        context.log(f"Skipping task {task['name']}: No valid article retrieved")
+    mark_task_done(databases, task['$id'], task['name'], context)
+    return articles
+
+def collect_task_items(task, context, start_time, quota):
+    items = []
+    if time.time() - start_time > 550:
+        context.log(f"Approaching 600-second timeout. Skipping task: {task['name']}")
+        return False, items
+    context.log(f"Collecting entries for task: {task['name']} (Elapsed time: {time.time() - start_time:.2f} seconds)")
+    feed = fetch_rss_feed(task, context, start_time, refine=False)
+    started = False
+    try:
+        while True:
+            if not reserve_article_slot(quota):
+                context.log(f"Per-run article quota reached. Stopping task {task['name']}")
+                break
+            started = True
+            item = next(feed, None)
+            if item is None:
+                release_article_slot(quota)
+                break
+            item['task_id'] = task['$id']
+            items.append(item)
+    finally:
+        feed.close()
+    return started, items
+
+def process_tasks_batched(selected_tasks, context, databases, start_time, valid_categories, quota, workers, batch_size):
+    # Scrape every selected feed first, then refine the collected entries LLM_BATCH_SIZE at a time,
+    # so articles from different feeds can share one provider round trip.
+    results = []
+    with ThreadPoolExecutor(max_workers=min(workers, len(selected_tasks))) as executor:
+        collected = list(executor.map(lambda task: collect_task_items(task, context, start_time, quota), selected_tasks))
+    items = [item for _, task_items in collected for item in task_items]
+    batches = [items[offset:offset + batch_size] for offset in range(0, len(items), batch_size)]
+    context.log(f"Refining {len(items)} articles in {len(batches)} batches of up to {batch_size}")
+
+    def refine_batch(batch):
+        # None instead of a result list means the batch was never sent, so its entries stay unseen without counting a failed attempt.
+        if time.time() - start_time > 550:
+            context.log(f"Approaching 600-second timeout. Skipping a batch of {len(batch)} articles")
+            return None
+        with stage_slot('ai'):
+            return refine_articles_with_ai(batch, context)
+
+    if batches:
+        with ThreadPoolExecutor(max_workers=min(workers, len(batches))) as executor:
+            refined_batches = list(executor.map(refine_batch, batches))
+        task_lookup = {task['$id']: task for task in selected_tasks}
+        for batch, refined_results in zip(batches, refined_batches):
+            if refined_results is None:
+                continue
+            for item, refined_data in zip(batch, refined_results):
+                if not refined_data:
+                    context.log(f"AI processing failed for {item['feed_name']}. Skipping article.")
+                    record_entry_failure(item['feed_url'], item['entry'], context)
+                    continue
+                mark_entry_seen(item['feed_url'], item['entry'], context)
+                article = assemble_article(item, refined_data, item['task_id'])
+                if store_article(article, task_lookup[item['task_id']], context, databases, valid_categories):
+                    results.append(article)
+
+    for task, (started, _) in zip(selected_tasks, collected):
+        if started:
+            mark_task_done(databases, task['$id'], task['name'], context)
+    return results
+
 def process_rss_feeds(context, databases, start_time):
     results = []
-    valid_categories = ['سیاست', 'اقتصاد', 'فناوری', 'سلامت', 'ورزش', 'سرگرمی', 'جهان']
+    valid_categories = VALID_CATEGORIES
+    tasks_per_run = max(1, get_int_env('TASKS_PER_RUN', 2))
+    max_concurrent_tasks = max(1, get_int_env('MAX_CONCURRENT_TASKS', 1))
+    quota = {'remaining': max(1, get_int_env('ARTICLES_PER_RUN', 10)), 'lock': threading.Lock()}
 
     context.log("Fetching tasks with isdone: false")
     try:
@@ -408,7 +2536,7 @@ def process_rss_feeds(context, databases, start_time):
         context.log(f"Failed to fetch tasks: {str(e)}")
         return results
 
-    if len(tasks) <= 2:
+    if len(tasks) <= tasks_per_run:
         context.log(f"{len(tasks)} tasks with isdone: false. Processing remaining tasks and resetting all tasks.")
         selected_tasks = tasks
         try:
@@ -432,187 +2560,45 @@ def process_rss_feeds(context, databases, start_time):
         except Exception as e:
             context.log(f"Failed to reset tasks: {str(e)}")
     else:
-        selected_tasks = random.sample(tasks, 2)
-        context.log(f"Selected 2 tasks: {[task['name'] for task in selected_tasks]}")
+        selected_tasks = random.sample(tasks, tasks_per_run)
+        context.log(f"Selected {len(selected_tasks)} tasks: {[task['name'] for task in selected_tasks]}")
 
     if not selected_tasks:
         context.log("No tasks to process. Exiting.")
         return results
 
-    for task in selected_tasks:
-        if time.time() - start_time > 550:
-            context.log(f"Approaching 600-second timeout. Stopping task processing.")
-            break
-
-        elapsed_time = time.time() - start_time
-        context.log(f"Processing task: {task['name']} (Elapsed time: {elapsed_time:.2f} seconds)")
-
-        article = fetch_rss_feed(task, context, start_time, databases)
-        if not article:
-            context.log(f"Skipping task {task['name']}: No valid article retrieved")
-            continue
-
-        title = article['title']
-        source = article['source']
-        task_id = article['task_id']
+    ARTICLE_CLASSIFIER['databases'] = databases
+    if os.environ.get('LOCAL_CLASSIFIER', '0') == '1':
+        ensure_article_classifier(databases, context)
 
-        try:
-            context.log(f"Checking for duplicates: {title}")
-            existing = databases.list_documents(
-                database_id=os.environ['APPWRITE_DATABASE_ID'],
-                collection_id=os.environ['APPWRITE_NEWS_ARTICLES_COLLECTION_ID'],
-                queries=[Query.equal("title", title), Query.equal("date", datetime.utcnow().strftime('%Y-%m-%d'))]
-            )
-            if existing['total'] > 0:
-                context.log(f"Duplicate article found from {source}: {title}. Marking task as isdone: true")
-                try:
-                    databases.update_document(
-                        database_id=os.environ['APPWRITE_DATABASE_ID'],
-                        collection_id=os.environ['APPWRITE_SCRAPE_TASKS_COLLECTION_ID'],
-                        document_id=task_id,
-                        data={"isdone": True}
-                    )
-                    context.log(f"Updated task {task['name']} (ID: {task_id}) isdone to true due to duplicate")
-                except Exception as e:
-                    context.log(f"Failed to update task '{task['name']}' isdone: {str(e)}")
-                continue
-        except Exception as e:
-            context.log(f"Failed to check duplicates for '{title}' from {source}: {str(e)}")
-            continue
+    batch_size = max(1, get_int_env('LLM_BATCH_SIZE', 1))
+    if batch_size > 1:
+        return process_tasks_batched(selected_tasks, context, databases, start_time, valid_categories, quota, max_concurrent_tasks, batch_size)
 
-        required_keys = ['title', 'summary', 'full_explanation', 'citations', 'category', 'tags']
-        if not all(key in article for key in required_keys):
-            context.log(f"Invalid article data from {source}: {json.dumps(article)}")
-            try:
-                context.log(f"Updating task {task['name']} (ID: {task_id}) isdone to true due to invalid article data")
-                databases.update_document(
-                    database_id=os.environ['APPWRITE_DATABASE_ID'],
-                    collection_id=os.environ['APPWRITE_SCRAPE_TASKS_COLLECTION_ID'],
-                    document_id=task_id,
-                    data={"isdone": True}
-                )
-                context.log(f"Updated task {task['name']} isdone to true")
-            except Exception as e:
-                context.log(f"Failed to update task '{task['name']}' isdone: {str(e)}")
-            continue
+    if max_concurrent_tasks == 1 or len(selected_tasks) == 1:
+        for task in selected_tasks:
+            if time.time() - start_time > 550:
+                context.log(f"Approaching 600-second timeout. Stopping task processing.")
+                break
+            if quota['remaining'] <= 0:
+                context.log("Per-run article quota reached. Stopping task processing.")
+                break
+            results.extend(process_task(task, context, databases, start_time, valid_categories, quota))
+        return results
 
-        if article['category'] not in valid_categories:
-            context.log(f"Invalid category for '{title}' from {source}: {article['category']}. Setting to 'جهان'")
-            article['category'] = 'جهان'
-        if len(article['summary']) > 100:
-            article['summary'] = article['summary'][:100]
-            context.log(f"Truncated summary to 100 chars for '{title}' from {source}")
-        if len(article['full_explanation']) > 2000:
-            context.log(f"full_explanation too long ({len(article['full_explanation'])} chars) for '{title}' from {source}. Truncating gracefully.")
-            article['full_explanation'] = truncate_text(article['full_explanation'], 2000)
-
-        doc = {
-            'title': article['title'],
-            'summary': article['summary'],
-            'full_explanation': article['full_explanation'],
-            'citations': article['citations'],
-            'date': datetime.utcnow().strftime('%Y-%m-%d'),
-            'source': source,
-            'tags': article['tags'],
-            'category': article['category']
+    workers = min(max_concurrent_tasks, len(selected_tasks))
+    context.log(f"Processing {len(selected_tasks)} tasks concurrently with {workers} workers")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(process_task, task, context, databases, start_time, valid_categories, quota): task
+            for task in selected_tasks
         }
-
-        try:
-            context.log(f"Storing article: {title}")
-            databases.create_document(
-                database_id=os.environ['APPWRITE_DATABASE_ID'],
-                collection_id=os.environ['APPWRITE_NEWS_ARTICLES_COLLECTION_ID'],
-                document_id='unique()',
-                data=doc
-            )
-            context.log(f"Stored article: {title} from {source}")
-
-            # Telegram Posting Logic
-            telegram_token = os.environ.get('TELEGRAM_TOKEN')
-            telegram_chat_id = os.environ.get('TELEGRAM_CHAT_ID')
-            if not telegram_token or not telegram_chat_id:
-                context.log("TELEGRAM_TOKEN or TELEGRAM_CHAT_ID not found. Skipping Telegram posting.")
-            else:
-                citation = article['citations'][0] if article['citations'] else None
-                title_escaped = html.escape(article['title'])
-                summary_escaped = html.escape(article['summary'])
-                full_explanation_escaped = html.escape(article['full_explanation'])
-                tags_escaped = html.escape(', '.join(article['tags']))
-
-                message = (
-                    f"<b>عنوان خبر:</b> {title_escaped}\n\n"
-                    f"<b>برچسب‌ها:</b> {tags_escaped}\n\n"
-                    f"<b>خلاصه خبر:</b> {summary_escaped}\n\n"
-                    f"<b>جزئیات کامل:</b> {full_explanation_escaped}\n\n"
-                )
-                if citation:
-                    message += f"<a href='{citation}'>بیشتر بخوانید</a>"
-
-                if len(message) > 4096:
-                    fixed_parts = (
-                        f"<b>عنوان خبر:</b> {title_escaped}\n\n"
-                        f"<b>برچسب‌ها:</b> {tags_escaped}\n\n"
-                        f"<b>خلاصه خبر:</b> {summary_escaped}\n\n"
-                        f"<b>جزئیات کامل:</b> "
-                        + (f"<a href='{citation}'>بیشتر بخوانید</a>" if citation else "")
-                    )
-                    remaining_chars = 4096 - len(fixed_parts) - 50
-                    full_explanation_escaped = truncate_text(full_explanation_escaped, remaining_chars)
-                    message = (
-                        f"<b>عنوان خبر:</b> {title_escaped}\n\n"
-                        f"<b>برچسب‌ها:</b> {tags_escaped}\n\n"
-                        f"<b>خلاصه خبر:</b> {summary_escaped}\n\n"
-                        f"<b>جزئیات کامل:</b> {full_explanation_escaped}\n\n"
-                    )
-                    if citation:
-                        message += f"<a href='{citation}'>بیشتر بخوانید</a>"
-
-                url = f"https://api.telegram.org/bot{telegram_token}/sendMessage"
-                payload = {
-                    "chat_id": telegram_chat_id,
-                    "text": message,
-                    "parse_mode": "HTML"
-                }
-                try:
-                    response = requests.post(url, json=payload, timeout=5)
-                    if response.status_code == 200:
-                        context.log(f"Sent Telegram message for article: {title}")
-                    else:
-                        error_response = response.text
-                        context.log(f"Failed to send Telegram message for article: {title}. Status code: {response.status_code}. Error: {error_response}")
-                except Exception as e:
-                    context.log(f"Exception while sending Telegram message for article: {title}. Error: {str(e)}")
-
-        except Exception as e:
-            context.log(f"Failed to store article '{title}' from {source}: {str(e)}")
+        for future in as_completed(futures):
+            task = futures[future]
             try:
-                context.log(f"Updating task {task['name']} (ID: {task_id}) isdone to true due to storage failure")
-                databases.update_document(
-                    database_id=os.environ['APPWRITE_DATABASE_ID'],
-                    collection_id=os.environ['APPWRITE_SCRAPE_TASKS_COLLECTION_ID'],
-                    document_id=task_id,
-                    data={"isdone": True}
-                )
-                context.log(f"Updated task {task['name']} isdone to true")
+                results.extend(future.result())
             except Exception as e:
-                context.log(f"Failed to update task '{task['name']}' isdone: {str(e)}")
-            continue
-
-        try:
-            context.log(f"Updating task {task['name']} (ID: {task_id}) isdone to true")
-            databases.update_document(
-                database_id=os.environ['APPWRITE_DATABASE_ID'],
-                collection_id=os.environ['APPWRITE_SCRAPE_TASKS_COLLECTION_ID'],
-                document_id=task_id,
-                data={"isdone": True}
-            )
-            context.log(f"Updated task {task['name']} isdone to true")
-        except Exception as e:
-            context.log(f"Failed to update task '{task['name']}' isdone: {str(e)}")
-            continue
-
-        results.append(article)
-        context.log(f"Processed article from {source}: {json.dumps(article, ensure_ascii=False)}")
+                context.log(f"Task '{task['name']}' raised an unexpected error: {str(e)}")
 
     return results
 
@@ -620,6 +2606,7 @@ def main(context):
     req = context.req
     res = context.res
     start_time = time.time()
+    reset_cache_stats()
 
     try:
         context.log(f"Function execution started at: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC')}")
@@ -646,6 +2633,7 @@ def main(context):
         results = process_rss_feeds(context, databases, start_time)
         elapsed_time = time.time() - start_time
         context.log(f"Processing completed successfully with {len(results)} articles in {elapsed_time:.2f} seconds")
+        context.log(f"Cache statistics: {format_cache_stats()}")
         return res.json({'message': 'Processing completed successfully', 'articles': len(results)})
 
     except Exception as e: